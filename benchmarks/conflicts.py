@@ -0,0 +1,93 @@
+from datetime import datetime
+import random, time
+from utilities.intervals import IntervalIndex, from_minutes, to_minutes
+
+'''
+CONFLICT CHECK BENCHMARK
+Times conflict queries on synthetic days of facility bookings: the
+IntervalIndex used by list_conflicts against the strptime scan it replaced.
+Run from the repository root with `python -m benchmarks.conflicts`.
+'''
+BOOKINGS_PER_DAY = [10, 100, 1000, 5000]
+QUERIES = 1000
+
+
+def synthetic_day(count: int, rng) -> list:
+
+    bookings = []
+    for number in range(count):
+        start = rng.randrange(7 * 60, 21 * 60)
+        end = min(start + rng.choice([15, 30, 60, 90, 120]), 24 * 60 - 1)
+        bookings.append({
+            'id': f'event{number}',
+            'extendedProperties': {'shared': {'start_time': from_minutes(start), 'end_time': from_minutes(end)}}
+        })
+    return bookings
+
+
+# list_conflicts before the interval index: parse every booking and test it
+def scan_conflicts(bookings: list, start_time, end_time) -> list:
+
+    conflicts = []
+    for booking in bookings:
+        datetime_start_time = datetime.strptime(booking['extendedProperties']['shared']['start_time'], '%H:%M').time()
+        datetime_end_time = datetime.strptime(booking['extendedProperties']['shared']['end_time'], '%H:%M').time()
+        if (
+            (start_time > datetime_start_time and start_time < datetime_end_time)
+            or (end_time > datetime_start_time and end_time < datetime_end_time)
+            or (start_time <= datetime_start_time and end_time >= datetime_end_time)
+        ):
+            conflicts.append(booking['id'])
+    return conflicts
+
+
+def build_index(bookings: list) -> IntervalIndex:
+
+    index = IntervalIndex()
+    for booking in bookings:
+        details = booking['extendedProperties']['shared']
+        index.add(to_minutes(details['start_time']), to_minutes(details['end_time']), booking['id'])
+    return index
+
+
+def main() -> None:
+
+    rng = random.Random(0)
+    print(f"{'bookings':>9} {'scan µs/query':>14} {'index µs/query':>15} {'index build ms':>15} {'speedup':>8}")
+    for count in BOOKINGS_PER_DAY:
+        bookings = synthetic_day(count, rng)
+        queries = []
+        for _ in range(QUERIES):
+            start = rng.randrange(7 * 60, 21 * 60)
+            queries.append((from_minutes(start), from_minutes(start + rng.choice([30, 60, 120]))))
+
+        started = time.perf_counter()
+        index = build_index(bookings)
+        build_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        scanned = [
+            scan_conflicts(
+                bookings,
+                datetime.strptime(start_time, '%H:%M').time(),
+                datetime.strptime(end_time, '%H:%M').time()
+            )
+            for start_time, end_time in queries
+        ]
+        scan_seconds = (time.perf_counter() - started) / QUERIES
+
+        started = time.perf_counter()
+        indexed = [index.overlapping(to_minutes(start_time), to_minutes(end_time)) for start_time, end_time in queries]
+        index_seconds = (time.perf_counter() - started) / QUERIES
+
+        # Both must find the same bookings, in any order
+        assert [sorted(result) for result in scanned] == [sorted(result) for result in indexed]
+        print(
+            f'{count:>9} {scan_seconds * 1e6:>14.1f} {index_seconds * 1e6:>15.1f} '
+            f'{build_seconds * 1e3:>15.2f} {scan_seconds / index_seconds:>7.0f}x'
+        )
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import time
+import ujson
+from telegram import Bot
+from telegram.utils.request import Request
+
+'''
+BOT CONNECTION BENCHMARK
+Counts the TCP connections a booking flow opens to the Bot API, with a
+fresh Bot built for each call (as before the shared client) and with one
+shared Bot. Requests go to a local stub of the Bot API, so no token or
+network is needed. TLS would add a handshake to every new connection.
+Run from the repository root with `python -m benchmarks.connections`.
+'''
+BOOKINGS = 20
+TOKEN = '123:benchmarkbenchmarkbenchmarkbenchmark'
+
+connections = 0
+connections_lock = Lock()
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # keep-alive, like api.telegram.org
+
+    def setup(self) -> None:
+
+        global connections
+        super().setup()
+        with connections_lock:
+            connections += 1
+
+    def do_POST(self) -> None:
+
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        chat = {'id': 1, 'type': 'private'}
+        if self.path.endswith('/getChat'):
+            result = chat
+        else:
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': 'ok'}
+        body = ujson.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        return
+
+
+# One booking: the confirmation reply, a POC privacy lookup and the channel post
+def booking_flow(reply_bot, other_bot) -> None:
+
+    reply_bot.edit_message_text(chat_id = 1, message_id = 1, text = 'Booking confirmed')
+    other_bot().get_chat(1)
+    other_bot().send_message(chat_id = '@channel', text = 'New Booking')
+    return
+
+
+def count_connections(make_bot, shared: bool) -> int:
+
+    global connections
+    connections = 0
+    reply_bot = make_bot() # the dispatcher's bot, always long-lived
+    for _ in range(BOOKINGS):
+        booking_flow(reply_bot, (lambda: reply_bot) if shared else make_bot)
+    return connections
+
+
+def main() -> None:
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+    Thread(target = server.serve_forever, daemon = True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/bot'
+    make_bot = lambda: Bot(TOKEN, base_url = base_url, request = Request(con_pool_size = 8))
+
+    per_call = count_connections(make_bot, shared = False)
+    shared = count_connections(make_bot, shared = True)
+    print(f'{BOOKINGS} booking flows, 3 Bot API calls each')
+    print(f"{'client':<20} {'connections':>12} {'per booking':>12}")
+    print(f"{'Bot() per call':<20} {per_call:>12} {per_call / BOOKINGS:>12.2f}")
+    print(f"{'shared Bot':<20} {shared:>12} {shared / BOOKINGS:>12.2f}")
+    server.shutdown()
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import os, statistics, time
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+'''
+DATABASE LATENCY BENCHMARK
+Per-query latency of the profile lookup run by load_user_profile, with a
+new connection for each query (as before the pool) and with a connection
+checked out of a pool. Needs a Postgres database with the bot's tables:
+set DATABASE_URL, and DATABASE_SSLMODE if the server doesn't offer SSL.
+Run from the repository root with `python -m benchmarks.database`.
+'''
+QUERIES = 200
+QUERY = 'SELECT rank_and_name, company, username FROM users WHERE user_id = %s'
+
+
+def run_query(connection) -> None:
+
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(QUERY, (0,))
+            cursor.fetchone()
+    return
+
+
+def connect_per_query(url: str, sslmode: str) -> list:
+
+    latencies = []
+    for _ in range(QUERIES):
+        started = time.perf_counter()
+        connection = psycopg2.connect(url, sslmode = sslmode)
+        try:
+            run_query(connection)
+        finally:
+            connection.close()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def pooled(url: str, sslmode: str) -> list:
+
+    pool = ThreadedConnectionPool(1, 1, url, sslmode = sslmode)
+    latencies = []
+    try:
+        for _ in range(QUERIES):
+            started = time.perf_counter()
+            connection = pool.getconn()
+            try:
+                run_query(connection)
+            finally:
+                pool.putconn(connection)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        pool.closeall()
+    return latencies
+
+
+def main() -> None:
+
+    url = os.environ['DATABASE_URL']
+    sslmode = os.getenv('DATABASE_SSLMODE') or 'require'
+    print(f'{QUERIES} profile lookups, sslmode={sslmode}')
+    print(f"{'connection':<22} {'median ms':>10} {'p95 ms':>8}")
+    for name, benchmark in (('connect per query', connect_per_query), ('pooled', pooled)):
+        latencies = sorted(benchmark(url, sslmode))
+        print(f'{name:<22} {statistics.median(latencies) * 1e3:>10.2f} {latencies[int(len(latencies) * 0.95)] * 1e3:>8.2f}')
+    return
+
+
+if __name__ == '__main__':
+    main()
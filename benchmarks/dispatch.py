@@ -0,0 +1,96 @@
+from queue import Queue
+from threading import Event, Lock
+import time
+from telegram import Bot, Chat, Message, Update, User
+from telegram.ext import Dispatcher, TypeHandler
+from utilities.dispatch import ConcurrentDispatcher
+
+'''
+DISPATCHER LOAD BENCHMARK
+Feeds updates from simulated concurrent users through the stock Dispatcher,
+which handles one update at a time, and through ConcurrentDispatcher at
+several in-flight limits. Handlers are stubs that sleep for HANDLER_SECONDS
+in place of Calendar, database and Telegram calls, and check that each
+chat's updates arrive in order. Run from the repository root with
+`python -m benchmarks.dispatch`.
+'''
+USERS = 50
+UPDATES_PER_USER = 4
+HANDLER_SECONDS = 0.05 # a typical Calendar round trip
+IN_FLIGHT_LIMITS = [1, 4, 8, 16, 32]
+
+bot = Bot('123:benchmarkbenchmarkbenchmarkbenchmark') # never connects
+
+
+def make_updates() -> list:
+
+    updates = []
+    for sequence in range(UPDATES_PER_USER):
+        for user_id in range(1, USERS + 1):
+            user = User(id = user_id, first_name = 'User', is_bot = False)
+            message = Message(
+                message_id = sequence,
+                date = None,
+                chat = Chat(id = user_id, type = Chat.PRIVATE),
+                from_user = user,
+                text = 'benchmark',
+                bot = bot
+            )
+            updates.append(Update(update_id = sequence * USERS + user_id, message = message))
+    return updates
+
+
+class StubHandler:
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.handled = 0
+        self.last_seen = {} # chat id -> last message id handled
+        self.out_of_order = 0
+        self.done = Event()
+        self._lock = Lock()
+
+    def __call__(self, update, context) -> None:
+
+        time.sleep(HANDLER_SECONDS)
+        with self._lock:
+            chat_id = update.effective_chat.id
+            if self.last_seen.get(chat_id, -1) >= update.effective_message.message_id:
+                self.out_of_order += 1
+            self.last_seen[chat_id] = update.effective_message.message_id
+            self.handled += 1
+            if self.handled == self.expected:
+                self.done.set()
+
+
+def run(dispatcher, updates: list) -> tuple:
+
+    handler = StubHandler(len(updates))
+    dispatcher.add_handler(TypeHandler(Update, handler))
+    started = time.perf_counter()
+    for update in updates:
+        dispatcher.process_update(update)
+    handler.done.wait()
+    elapsed = time.perf_counter() - started
+    return len(updates) / elapsed, handler.out_of_order
+
+
+def main() -> None:
+
+    updates = make_updates()
+    print(f'{USERS} users, {len(updates)} updates, {HANDLER_SECONDS * 1000:.0f} ms per handler')
+    print(f"{'dispatcher':<28} {'updates/s':>10} {'out of order':>13}")
+
+    rate, out_of_order = run(Dispatcher(bot, Queue()), updates)
+    print(f"{'Dispatcher (sequential)':<28} {rate:>10.1f} {out_of_order:>13}")
+
+    for limit in IN_FLIGHT_LIMITS:
+        dispatcher = ConcurrentDispatcher(bot, Queue(), max_in_flight = limit)
+        rate, out_of_order = run(dispatcher, updates)
+        dispatcher._update_pool.shutdown(wait = True)
+        print(f"{f'ConcurrentDispatcher ({limit})':<28} {rate:>10.1f} {out_of_order:>13}")
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import statistics, subprocess, sys, time
+
+'''
+IMPORT TIME BENCHMARK
+Imports main in fresh interpreters under `python -X importtime` and reports
+the cumulative import time of main, the wall time of each interpreter
+(including disk I/O and interpreter startup) and the modules with the
+largest cumulative times. Importing main reads config, so run it with the
+bot's environment variables set, from the repository root:
+`python -m benchmarks.imports`.
+'''
+RUNS = 5
+TOP_MODULES = 15
+
+
+# -X importtime lines: 'import time:      self [us] |      cumulative | imported package'
+def parse_importtime(stderr: str) -> dict:
+
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, self_us, cumulative_us, module = (field.strip() for field in line.replace('import time:', '|', 1).split('|'))
+        cumulative[module] = int(cumulative_us) / 1e6
+    return cumulative
+
+
+def import_main() -> tuple:
+
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output = True, text = True)
+    wall_seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit(f'import main failed:\n{result.stderr[-2000:]}')
+    return parse_importtime(result.stderr), wall_seconds
+
+
+def main() -> None:
+
+    runs = [import_main() for _ in range(RUNS)]
+    main_seconds = [cumulative['main'] for cumulative, _ in runs]
+    wall_seconds = [wall for _, wall in runs]
+    print(f'{RUNS} runs of python -X importtime -c "import main"')
+    print(f'import main: median {statistics.median(main_seconds) * 1e3:.0f} ms, min {min(main_seconds) * 1e3:.0f} ms')
+    print(f'interpreter wall time: median {statistics.median(wall_seconds) * 1e3:.0f} ms, min {min(wall_seconds) * 1e3:.0f} ms')
+
+    # Median cumulative time per module across runs
+    modules = {module: statistics.median(cumulative.get(module, 0) for cumulative, _ in runs) for module in runs[0][0]}
+    print(f"\n{'cumulative ms':>14}  module")
+    for module, seconds in sorted(modules.items(), key = lambda item: item[1], reverse = True)[:TOP_MODULES]:
+        print(f'{seconds * 1e3:>14.1f}  {module}')
+    return
+
+
+if __name__ == '__main__':
+    main()
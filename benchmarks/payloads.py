@@ -0,0 +1,106 @@
+import json, time
+
+'''
+CALENDAR PAYLOAD BENCHMARK
+Compares the size and JSON parse time of an events.list page of full event
+resources with the same page under the partial-response mask the bot now
+requests (LIST_FIELDS in utilities/calendar.py). Events are synthetic but
+shaped like the API's: a bot-created event with the fields Google fills
+in. The client library parses responses with json.loads, as done here.
+Run from the repository root with `python -m benchmarks.payloads`.
+'''
+PAGE_SIZES = [50, 500, 2500]
+REPEATS = 20
+
+
+def full_event(number: int) -> dict:
+
+    event_id = f'{number:040x}'
+    shared = {
+        'facility': 'Conference Room 1',
+        'date': '2030-01-01',
+        'start_time': '09:00',
+        'end_time': '10:30',
+        'description': 'Weekly planning meeting',
+        'name_and_company': 'CPT Tan Ah Kow (ALPHA)',
+        'user_id': '123456789',
+        'username': 'tanahkow'
+    }
+    return {
+        'kind': 'calendar#event',
+        'etag': f'"{3300000000000000 + number}"',
+        'id': event_id,
+        'status': 'confirmed',
+        'htmlLink': f'https://www.google.com/calendar/event?eid={event_id}bookings',
+        'created': '2029-12-20T08:15:30.000Z',
+        'updated': '2029-12-20T08:15:30.512Z',
+        'summary': 'Conference Room 1 (ALPHA)',
+        'description': 'Activity: Weekly planning meeting\nPOC: CPT Tan Ah Kow (ALPHA)',
+        'colorId': '1',
+        'creator': {'email': 'facilities-bot@project.iam.gserviceaccount.com'},
+        'organizer': {'email': 'bookings@group.calendar.google.com', 'displayName': 'Facility Bookings', 'self': True},
+        'start': {'dateTime': '2030-01-01T09:00:00+08:00', 'timeZone': 'Asia/Singapore'},
+        'end': {'dateTime': '2030-01-01T10:30:00+08:00', 'timeZone': 'Asia/Singapore'},
+        'iCalUID': f'{event_id}@google.com',
+        'sequence': 0,
+        'extendedProperties': {'shared': shared},
+        'reminders': {'useDefault': True},
+        'eventType': 'default'
+    }
+
+
+# What the mask 'nextPageToken,nextSyncToken,items(id,status,htmlLink,extendedProperties/shared)' keeps
+def masked_event(event: dict) -> dict:
+
+    return {
+        'id': event['id'],
+        'status': event['status'],
+        'htmlLink': event['htmlLink'],
+        'extendedProperties': {'shared': event['extendedProperties']['shared']}
+    }
+
+
+def full_page(events: list) -> dict:
+
+    return {
+        'kind': 'calendar#events',
+        'etag': '"p33ca3fdd5nqvo0o"',
+        'summary': 'Facility Bookings',
+        'description': '',
+        'updated': '2029-12-20T08:15:30.512Z',
+        'timeZone': 'Asia/Singapore',
+        'accessRole': 'writer',
+        'defaultReminders': [],
+        'nextSyncToken': 'CLDu3ry4u_wCELDu3ry4u_wCGAUggICAgMDL6rYB',
+        'items': events
+    }
+
+
+def masked_page(events: list) -> dict:
+    return {'nextSyncToken': 'CLDu3ry4u_wCELDu3ry4u_wCGAUggICAgMDL6rYB', 'items': [masked_event(event) for event in events]}
+
+
+def parse_seconds(body: str) -> float:
+
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        json.loads(body)
+    return (time.perf_counter() - started) / REPEATS
+
+
+def main() -> None:
+
+    print(f"{'events':>7} {'full KB':>9} {'masked KB':>10} {'full parse ms':>14} {'masked parse ms':>16}")
+    for size in PAGE_SIZES:
+        events = [full_event(number) for number in range(size)]
+        full_body = json.dumps(full_page(events))
+        masked_body = json.dumps(masked_page(events))
+        print(
+            f'{size:>7} {len(full_body) / 1024:>9.1f} {len(masked_body) / 1024:>10.1f} '
+            f'{parse_seconds(full_body) * 1e3:>14.2f} {parse_seconds(masked_body) * 1e3:>16.2f}'
+        )
+    return
+
+
+if __name__ == '__main__':
+    main()
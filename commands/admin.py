@@ -1,5 +1,6 @@
 from datetime import timedelta
 import logging
+from uuid import uuid4
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 from utilities import filters, shared, keyboards, calendar, database
@@ -47,7 +48,8 @@ def save_booking_details(update: Update, context: CallbackContext) -> int:
         'start_time': context.time_range[0],
         'end_time': context.time_range[1],
         'time_range_input': context.time_range_input[0],
-        'description': context.description[0]
+        'description': context.description[0],
+        'booking_nonce': uuid4().hex # new booking request, so a new event id
     }
     context.chat_data['admin_user_data'] = {
         'rank_and_name': context.rank_and_name[0],
@@ -122,7 +124,9 @@ def confirm(update: Update, context: CallbackContext) -> int:
             user_id = context.chat_data['admin_user_data']['id'],
             user_data = context.chat_data['admin_user_data'],
             chat_data = context.chat_data['admin_chat_data'],
-            update_channel = False
+            update_channel = False,
+            reserve_slot = False,
+            notify_chat_id = update.effective_chat.id
         )
     except Exception as error:
         update.effective_chat.send_message(
@@ -236,5 +240,7 @@ handler = ConversationHandler(
         CommandHandler('cancel', cancel),
         MessageHandler(Filters.command, shared.silent_cancel)
     ],
-    allow_reentry = True
+    allow_reentry = True,
+    name = 'admin',
+    persistent = True
 )
\ No newline at end of file
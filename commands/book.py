@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 import logging
+from uuid import uuid4
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 from utilities import shared, keyboards, filters, calendar
@@ -20,6 +21,9 @@ def book(update: Update, context: CallbackContext) -> int:
     # Reset suggest_alt_facility preference
     context.chat_data['suggest_alt_facility'] = True
 
+    # New booking request, so a new event id
+    context.chat_data['booking_nonce'] = uuid4().hex
+
     # Ask user which facility to book
     update.effective_chat.send_message(
         text = 'Which facility do you want to book?',
@@ -130,21 +134,46 @@ def save_time_range(update: Update, context: CallbackContext) -> int:
     context.chat_data['datetime_start_time'] = context.start_time[1] # needed for list_conflicts function in calendar.py
     context.chat_data['datetime_end_time'] = datetime_end_time
 
-    # Check for conflicting bookings
-    if (conflicts := calendar.list_conflicts(context.chat_data)):
+    # Check for conflicting bookings, at the alternate facility too if there is one
+    alt_facility = config.ALT_FACILITIES.get(context.chat_data['facility'])
+    conflicts_by_facility = calendar.list_conflicts_by_facility(
+        context.chat_data,
+        [context.chat_data['facility'], alt_facility] if alt_facility else [context.chat_data['facility']]
+    )
+    if (conflicts := conflicts_by_facility[context.chat_data['facility']]):
+
+        # Offer the nearest free slots of the same length
+        suggested_slots = calendar.suggest_slots(
+            context.chat_data['facility'],
+            context.chat_data['date'],
+            context.chat_data['start_time'],
+            context.chat_data['end_time']
+        )
+        suggestion = 'tap a free time slot below, ' if suggested_slots else ''
+
+        # Point out other facilities that are free at the same time
+        free_facilities = [
+            facility for facility in calendar.find_free_facilities(
+                context.chat_data['date'],
+                context.chat_data['start_time'],
+                context.chat_data['end_time']
+            )
+            if facility != alt_facility or not context.chat_data['suggest_alt_facility'] # alt_facility is offered separately
+        ]
+        free_elsewhere = f'*{", ".join(free_facilities)}* {"is" if len(free_facilities) == 1 else "are"} free at this time. ' if free_facilities else ''
 
         # If alternate facilities are available
         message_end = None
-        reply_markup = keyboards.contact_poc(conflicts, update.effective_user.username)
+        reply_markup = keyboards.contact_poc(conflicts, update.effective_user.username, suggested_slots)
         context.chat_data['conflict_reply_markup'] = reply_markup # Store in case user rejects alt_facility
         conversation_state = TIME_RANGE
-        if (config.ALT_FACILITIES.get(context.chat_data['facility'])
+        if (alt_facility
             and context.chat_data['suggest_alt_facility'] # Don't suggest alt_facility again if user has already rejected it
         ):
-            if not calendar.list_conflicts(context.chat_data, facility = config.ALT_FACILITIES[context.chat_data['facility']]):
-                context.chat_data['alt_facility'] = config.ALT_FACILITIES[context.chat_data['facility']]
+            if not conflicts_by_facility[alt_facility]:
+                context.chat_data['alt_facility'] = alt_facility
                 context.chat_data['conflicts'] = conflicts # Store in case user rejects alt_facility
-                message_end = f'*{config.ALT_FACILITIES[context.chat_data["facility"]]}* is available, would you like to book it instead?'
+                message_end = f'*{alt_facility}* is available, would you like to book it instead?'
                 reply_markup = keyboards.yes_or_no
                 conversation_state = ALT_FACILITY
 
@@ -153,8 +182,8 @@ def save_time_range(update: Update, context: CallbackContext) -> int:
             message_start = f'The time range you sent me conflicts with these *{context.chat_data["facility"]}* bookings:\n\n'
 
             # Store in case user rejects alt_facility
-            conext.chat_data['conflict_message_start'] = 'These are the conflicting bookings:'
-            context.chat_data['conflict_message_end'] = 'Please send me another time range, or contact the POCs to deconflict.'
+            context.chat_data['conflict_message_start'] = 'These are the conflicting bookings:'
+            context.chat_data['conflict_message_end'] = f'{free_elsewhere}Please {suggestion}send me another time range, or contact the POCs to deconflict.'
 
             if not message_end:
                 message_end = context.chat_data['conflict_message_end']
@@ -217,7 +246,7 @@ def save_time_range(update: Update, context: CallbackContext) -> int:
 
                 # Store in case user rejects alt_facility
                 context.chat_data['conflict_message_start'] = "This is the conflicting booking:"
-                context.chat_data['conflict_message_end'] = 'Please send me another time range, or contact the POC to deconflict.'
+                context.chat_data['conflict_message_end'] = f'{free_elsewhere}Please {suggestion}send me another time range, or contact the POC to deconflict.'
 
                 if not message_end:
                     message_end = context.chat_data['conflict_message_end']
@@ -246,6 +275,22 @@ def save_time_range(update: Update, context: CallbackContext) -> int:
     return DESCRIPTION
 
 
+def save_suggested_slot(update: Update, context: CallbackContext) -> int:
+
+    query = update.callback_query
+
+    # CallbackQueries need to be answered, even if no user notification is needed
+    query.answer()
+
+    # Parse the slot the same way filters.time_range parses a typed time range
+    start_time = datetime.strptime(query.data[:4], '%H%M').time()
+    end_time = datetime.strptime(query.data[-4:], '%H%M').time()
+    context.start_time = [start_time.strftime('%H:%M'), start_time]
+    context.end_time = [end_time.strftime('%H:%M'), end_time]
+
+    return save_time_range(update, context)
+
+
 def alt_facility(update: Update, context: CallbackContext) -> int:
 
     query = update.callback_query
@@ -313,6 +358,26 @@ def patch_booking(update: Update, context: CallbackContext) -> int:
     return CONFIRMATION
 
 
+# Someone else reserved the slot after the conflict check
+def send_booking_conflict(update: Update, context: CallbackContext, error) -> None:
+
+    update.callback_query.answer()
+    update.callback_query.edit_message_text(
+        text =
+            f'⚠ Sorry, someone else has just booked *{context.chat_data["facility"]}* '
+            f'on *{context.chat_data["date"]}* at an overlapping time.\n\n'
+            'Send /book to choose another time.',
+        parse_mode = ParseMode.MARKDOWN
+    )
+    logger.info(
+        'Booking Conflict - %s - %s - %s',
+        update.effective_user.id,
+        context.user_data['rank_and_name'],
+        error
+    )
+    return
+
+
 def confirm(update: Update, context: CallbackContext) -> int:
 
     # Add Google Calendar event
@@ -320,8 +385,12 @@ def confirm(update: Update, context: CallbackContext) -> int:
         event_url = calendar.add_booking(
             user_id = update.effective_user.id,
             user_data = context.user_data,
-            chat_data = context.chat_data
+            chat_data = context.chat_data,
+            notify_chat_id = update.effective_chat.id
         )
+    except calendar.BookingConflict as error:
+        send_booking_conflict(update, context, error)
+        return ConversationHandler.END # -1
     except Exception as error:
         update.callback_query.edit_message_text(
             text =
@@ -379,8 +448,12 @@ def confirm_patch(update: Update, context: CallbackContext) -> int:
         event_url = calendar.patch_booking(
             user_id = update.effective_user.id,
             user_data = context.user_data,
-            chat_data = context.chat_data
+            chat_data = context.chat_data,
+            notify_chat_id = update.effective_chat.id
         )
+    except calendar.BookingConflict as error:
+        send_booking_conflict(update, context, error)
+        return ConversationHandler.END # -1
     except Exception as error:
         update.callback_query.edit_message_text(
             text =
@@ -468,6 +541,7 @@ handler = ConversationHandler(
         ],
         TIME_RANGE: [
             MessageHandler(filters.time_range, save_time_range),
+            CallbackQueryHandler(callback = save_suggested_slot, pattern = r'^\d{4}-\d{4}$'),
             MessageHandler(Filters.all & (~Filters.command), time_range_error)
         ],
         ALT_FACILITY: [CallbackQueryHandler(callback = alt_facility, pattern = 'confirm|cancel')],
@@ -487,5 +561,7 @@ handler = ConversationHandler(
         CommandHandler('cancel', cancel),
         MessageHandler(Filters.command, shared.silent_cancel)
     ],
-    allow_reentry = True
+    allow_reentry = True,
+    name = 'book',
+    persistent = True
 )
\ No newline at end of file
@@ -3,7 +3,6 @@ import logging
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 from utilities import shared, keyboards, filters, calendar
-import config
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +21,8 @@ def change(update: Update, context: CallbackContext) -> int:
         bookings = calendar.find_upcoming_bookings_by_user(update.effective_user.id)
     except Exception as error:
         update.effective_chat.send_message('⚠ Sorry, I could not connect to Google Calendar. Send /change to try again.')
+        logger.exception('Bookings Retrieval Failure - %s - %s', update.effective_user.id, error)
+        return ConversationHandler.END # -1
     
     bookings = bookings['ongoing'] + bookings['later_today'] + bookings['after_today']
     
@@ -29,7 +30,7 @@ def change(update: Update, context: CallbackContext) -> int:
     
         # Ask user to choose booking to change
         update.effective_chat.send_message(
-            text = "Ok, here are your bookings. Choose one to change or delete. Send /cancel to stop.",
+            text = f"{calendar.stale_notice()}Ok, here are your bookings. Choose one to change or delete. Send /cancel to stop.",
             reply_markup = keyboards.user_bookings(bookings),
         )
         return BOOKING
@@ -51,10 +52,12 @@ def load_booking(update: Update, context: CallbackContext) -> int:
     # Save event id to change or delete it later
     context.chat_data['event_id'] = query.data
     
-    booking = calendar.service.events().get(
-        calendarId = config.CALENDAR_ID,
-        eventId = context.chat_data['event_id']
-    ).execute()
+    try:
+        booking = calendar.get_booking(context.chat_data['event_id'])
+    except Exception as error:
+        update.callback_query.edit_message_text('⚠ Sorry, I could not connect to Google Calendar. Send /change to try again.')
+        logger.exception('Booking Retrieval Failure - %s - %s', context.chat_data['event_id'], error)
+        return ConversationHandler.END # -1
     
     # Load booking details
     context.chat_data['facility'] = booking['extendedProperties']['shared']['facility']
@@ -410,8 +413,25 @@ def confirm_change(update: Update, context: CallbackContext) -> int:
         event_url = calendar.patch_booking(
             user_id = update.effective_user.id,
             user_data = context.user_data,
-            chat_data = context.chat_data
+            chat_data = context.chat_data,
+            notify_chat_id = update.effective_chat.id
+        )
+    except calendar.BookingConflict as error:
+        update.callback_query.answer()
+        update.callback_query.edit_message_text(
+            text =
+                f'⚠ Sorry, someone else has just booked *{context.chat_data["facility"]}* '
+                f'on *{context.chat_data["date"]}* at an overlapping time, so your booking is unchanged.\n\n'
+                'Send /change to choose another time.',
+            parse_mode = ParseMode.MARKDOWN
+        )
+        logger.info(
+            'Booking Conflict - %s - %s - %s',
+            update.effective_user.id,
+            context.user_data['rank_and_name'],
+            error
         )
+        return ConversationHandler.END # -1
     except Exception as error:
         update.effective_chat.send_message(
             text = '⚠ Sorry, I could not connect to Google Calendar. Try again?',
@@ -464,7 +484,8 @@ def confirm_delete(update: Update, context: CallbackContext) -> int:
         calendar.delete_booking(
             user_id = update.effective_user.id, 
             user_data = context.user_data, 
-            chat_data = context.chat_data
+            chat_data = context.chat_data, 
+            notify_chat_id = update.effective_chat.id
         )
     except Exception as error:
         update.effective_chat.send_message(
@@ -553,5 +574,7 @@ handler = ConversationHandler(
         CommandHandler('cancel', cancel),
         MessageHandler(Filters.command, shared.silent_cancel)
     ],
-    allow_reentry = True
+    allow_reentry = True,
+    name = 'change',
+    persistent = True
 )
\ No newline at end of file
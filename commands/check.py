@@ -1,7 +1,12 @@
 from datetime import datetime
+import logging
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
 from utilities import shared, keyboards, calendar
+import config
+
+logger = logging.getLogger(__name__)
+
 
 SHOW_BOOKINGS = 0
 
@@ -11,15 +16,83 @@ CHECK ENTRY POINT
 @shared.send_typing_action
 def check(update: Update, context: CallbackContext) -> int:
     
+    # /check DDMMYY HHmm-HHmm checks every facility at once
+    if context.args:
+        return show_free_facilities(update, context)
+    
     # Ask user to choose a facility to check
     update.effective_chat.send_message(
-        text = "Which facility's availability would you like to check?",
-        reply_markup = keyboards.facilities
+        text = 
+            "Which facility's availability would you like to check?\n\n"
+            "To see which facilities are free at a certain time, send `/check DDMMYY HHmm-HHmm`.",
+        reply_markup = keyboards.facilities,
+        parse_mode = ParseMode.MARKDOWN
     )
     
     return SHOW_BOOKINGS
 
 
+'''
+SEND FREE FACILITIES FOR A DATE AND TIME RANGE
+'''
+def show_free_facilities(update: Update, context: CallbackContext) -> int:
+    
+    try:
+        datetime_date = datetime.strptime(context.args[0], '%d%m%y').date()
+        datetime_start_time = datetime.strptime(context.args[1][:4], '%H%M')
+        datetime_end_time = datetime.strptime(context.args[1][-4:], '%H%M')
+    except (IndexError, ValueError):
+        datetime_date = None
+    
+    if (not datetime_date
+        or datetime_date < datetime.now(config.TIMEZONE).date()
+        or datetime_start_time >= datetime_end_time
+    ):
+        update.effective_chat.send_message(
+            text = "⚠ Sorry, I couldn't read that. Send `/check DDMMYY HHmm-HHmm` (e.g. `/check 010622 0930-1300`).",
+            parse_mode = ParseMode.MARKDOWN
+        )
+        return ConversationHandler.END
+    
+    date = datetime_date.strftime('%Y-%m-%d')
+    start_time = datetime_start_time.strftime('%H:%M')
+    end_time = datetime_end_time.strftime('%H:%M')
+    try:
+        free_facilities = calendar.find_free_facilities(date, start_time, end_time)
+    except Exception as error:
+        update.effective_chat.send_message('⚠ Sorry, I could not connect to Google Calendar. Send /check to try again.')
+        logger.exception('Availability Retrieval Failure - %s %s-%s - %s', date, start_time, end_time, error)
+        return ConversationHandler.END
+    booked_facilities = [facility for facility in config.FACILITIES if facility not in free_facilities]
+    
+    message = f"{calendar.stale_notice()}*{datetime_date.strftime('%d %b %Y')}, {start_time}-{end_time}*\n"
+    
+    if free_facilities:
+        message += '\n*Free*\n'
+        for facility in free_facilities:
+            message += f'{facility}\n'
+    
+    if booked_facilities:
+        message += '\n*Booked*\n'
+        duration = (datetime_end_time - datetime_start_time).seconds // 60
+        free_ranges = calendar.find_first_free_ranges(date, duration, facilities = booked_facilities)
+        for facility in booked_facilities:
+            if (free_range := free_ranges[facility]):
+                message += f'{facility} (free from {free_range[0]}-{free_range[1]})\n'
+            else:
+                message += f'{facility}\n'
+    
+    message += '\nUse /book to make a new booking.'
+    
+    update.effective_chat.send_message(
+        text = message,
+        parse_mode = ParseMode.MARKDOWN,
+        reply_markup = keyboards.view_calendar
+    )
+    
+    return ConversationHandler.END
+
+
 '''
 SEND UPCOMING BOOKINGS FOR CHOSEN FACILITY
 '''
@@ -27,7 +100,13 @@ SEND UPCOMING BOOKINGS FOR CHOSEN FACILITY
 def show_bookings(update: Update, context: CallbackContext) -> int:
     
     facility = update.callback_query.data
-    bookings = calendar.find_upcoming_bookings_by_facility(facility)
+    try:
+        bookings = calendar.find_upcoming_bookings_by_facility(facility)
+    except Exception as error:
+        update.callback_query.answer()
+        update.callback_query.edit_message_text('⚠ Sorry, I could not connect to Google Calendar. Send /check to try again.')
+        logger.exception('Bookings Retrieval Failure - %s - %s', facility, error)
+        return ConversationHandler.END
     
     if not bookings['ongoing'] and not bookings['later_today'] and not bookings['after_today']:
         message = f"*{facility}* has no ongoing or upcoming bookings.\n\nUse /book to make a new booking, or access the bookings calendar by tapping the link below."
@@ -60,7 +139,7 @@ def show_bookings(update: Update, context: CallbackContext) -> int:
                 
     update.callback_query.answer()
     update.callback_query.edit_message_text(
-        text = message,
+        text = calendar.stale_notice() + message,
         parse_mode = ParseMode.MARKDOWN,
         reply_markup = keyboards.view_calendar
     )
@@ -75,5 +154,7 @@ handler = ConversationHandler(
     entry_points = [CommandHandler('check', check)],
     states = {SHOW_BOOKINGS: [CallbackQueryHandler(show_bookings)]},
     fallbacks = [MessageHandler(Filters.command, shared.silent_cancel)],
-    allow_reentry = True
+    allow_reentry = True,
+    name = 'check',
+    persistent = True
 )
\ No newline at end of file
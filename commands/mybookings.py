@@ -1,8 +1,11 @@
 from datetime import datetime
+import logging
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext, CommandHandler
 from utilities import calendar, shared, keyboards
 
+logger = logging.getLogger(__name__)
+
 '''
 MYBOOKINGS CALLBACK FUNCTION
 '''
@@ -10,7 +13,12 @@ MYBOOKINGS CALLBACK FUNCTION
 @shared.load_user_profile
 def show_upcoming_user_bookings(update: Update, context: CallbackContext) -> None:
     
-    bookings = calendar.find_upcoming_bookings_by_user(update.effective_user.id)
+    try:
+        bookings = calendar.find_upcoming_bookings_by_user(update.effective_user.id)
+    except Exception as error:
+        update.effective_chat.send_message('⚠ Sorry, I could not connect to Google Calendar. Send /mybookings to try again.')
+        logger.exception('Bookings Retrieval Failure - %s - %s', update.effective_user.id, error)
+        return
     
     if not bookings['ongoing'] and not bookings['later_today'] and not bookings['after_today']:
         message = "You don't have any ongoing or upcoming bookings.\n\nTap the link below to open the bookings calendar."
@@ -43,7 +51,7 @@ def show_upcoming_user_bookings(update: Update, context: CallbackContext) -> Non
         message += "\nTap the link below to open the bookings calendar."
     
     update.effective_chat.send_message(
-        text = message,
+        text = calendar.stale_notice() + message,
         parse_mode = ParseMode.MARKDOWN,
         reply_markup = keyboards.view_calendar
     )
@@ -288,5 +288,7 @@ handler = ConversationHandler(
     fallbacks = [
         CommandHandler('cancel', cancel),
         MessageHandler(Filters.command, shared.silent_cancel)
-    ]
+    ],
+    name = 'start',
+    persistent = True
 )
\ No newline at end of file
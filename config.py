@@ -5,6 +5,14 @@ import ujson
 # INFRASTRUCTURE
 WEBHOOK_URL = os.environ['WEBHOOK_URL']
 DATABASE_URL = os.environ['DATABASE_URL']
+DATABASE_POOL_MIN = int(os.getenv('DATABASE_POOL_MIN') or 1)
+DATABASE_POOL_MAX = int(os.getenv('DATABASE_POOL_MAX') or 8)
+DATABASE_POOL_IDLE_CHECK = int(os.getenv('DATABASE_POOL_IDLE_CHECK') or 60) # seconds idle before a connection is pinged on checkout
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE') or 1024)
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL') or 3600) # seconds
+USERNAME_FLUSH_INTERVAL = int(os.getenv('USERNAME_FLUSH_INTERVAL') or 30) # seconds
+USERNAME_FLUSH_SIZE = int(os.getenv('USERNAME_FLUSH_SIZE') or 100)
+PERSISTENCE_FLUSH_INTERVAL = int(os.getenv('PERSISTENCE_FLUSH_INTERVAL') or 10) # seconds between writes of changed conversation state
 
 # TELEGRAM
 BOT_TOKEN = os.environ['BOT_TOKEN']
@@ -12,6 +20,15 @@ WEBHOOK_PORT = os.getenv('PORT') or 8443
 ADMIN_USERS = set(ujson.loads(os.getenv('ADMIN_USERS') or '[]'))
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME')
 CHANNEL_MUTED = (os.getenv('CHANNEL_MUTED') == 'True')
+CHANNEL_POSTS_PER_MINUTE = int(os.getenv('CHANNEL_POSTS_PER_MINUTE') or 20) # Telegram allows about 20 per minute per channel
+CHANNEL_DIGEST_THRESHOLD = int(os.getenv('CHANNEL_DIGEST_THRESHOLD') or 3) # posts waiting in the outbox that trigger a digest
+CHANNEL_DIGEST_MAX_POSTS = int(os.getenv('CHANNEL_DIGEST_MAX_POSTS') or 20) # most queued posts sent in one digest
+PRIVACY_CACHE_SIZE = int(os.getenv('PRIVACY_CACHE_SIZE') or 1024)
+PRIVACY_CACHE_TTL = int(os.getenv('PRIVACY_CACHE_TTL') or 6 * 3600) # seconds
+PRIVACY_LOOKUP_WORKERS = int(os.getenv('PRIVACY_LOOKUP_WORKERS') or 4)
+TYPING_ACTION_DELAY = float(os.getenv('TYPING_ACTION_DELAY') or 0.5) # seconds before showing 'typing...' for slow handlers
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL') or 900) # seconds, 0 disables
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES') or 8) # chats handled at the same time
 COMMANDS_BOOKING = [
     ("book", "Make a new booking"), 
     ("change", "Change or delete a booking"), 
@@ -30,10 +47,39 @@ COMMANDS_ADMIN = [
 CALENDAR_ID = os.environ['CALENDAR_ID']
 CALENDAR_URL = os.getenv('CALENDAR_URL')
 SERVICE_ACCOUNT_INFO = ujson.loads(os.environ['SERVICE_ACCOUNT_INFO'])
+CALENDAR_SYNC_INTERVAL = int(os.getenv('CALENDAR_SYNC_INTERVAL') or 15) # seconds between incremental syncs
+CALENDAR_PAGE_SIZE = int(os.getenv('CALENDAR_PAGE_SIZE') or 2500) # events per events.list page, 2500 at most
+CALENDAR_TOKEN_REFRESH_MARGIN = int(os.getenv('CALENDAR_TOKEN_REFRESH_MARGIN') or 600) # seconds before expiry to renew the access token
+CALENDAR_TOKEN_RETRY_INTERVAL = int(os.getenv('CALENDAR_TOKEN_RETRY_INTERVAL') or 30) # seconds between failed refresh attempts
+CALENDAR_TIMEOUT = float(os.getenv('CALENDAR_TIMEOUT') or 10) # seconds per HTTP request to Google
+CALENDAR_BREAKER_THRESHOLD = int(os.getenv('CALENDAR_BREAKER_THRESHOLD') or 5) # consecutive failures that open the circuit
+CALENDAR_BREAKER_RESET = int(os.getenv('CALENDAR_BREAKER_RESET') or 30) # seconds before an open circuit lets a trial request through
+CALENDAR_STALE_AFTER = int(os.getenv('CALENDAR_STALE_AFTER') or 120) # seconds since the last sync before replies are marked stale
+CALENDAR_QUOTA_PER_SECOND = float(os.getenv('CALENDAR_QUOTA_PER_SECOND') or 10) # requests, shared by reads and writes; Google allows 600 per minute per user by default
+CALENDAR_READS_PER_SECOND = float(os.getenv('CALENDAR_READS_PER_SECOND') or 8)
+CALENDAR_WRITES_PER_SECOND = float(os.getenv('CALENDAR_WRITES_PER_SECOND') or 5)
+CALENDAR_THROTTLE_TIMEOUT = float(os.getenv('CALENDAR_THROTTLE_TIMEOUT') or 5) # seconds a request may queue for a token
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS') or 2)
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL') or 5) # seconds between checks for jobs recorded by other processes
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS') or 15)
+OUTBOX_RETRY_BASE_DELAY = float(os.getenv('OUTBOX_RETRY_BASE_DELAY') or 0.5) # seconds, doubled each attempt and jittered
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv('OUTBOX_RETRY_MAX_DELAY') or 300)
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE') or 60) # seconds before a job claimed by a process that died is retried
+OUTBOX_CONFIRM_WAIT = float(os.getenv('OUTBOX_CONFIRM_WAIT') or 3) # seconds a confirmation waits for the event link
+
+# TELEGRAM CONNECTION POOL
+# One connection for each thread that can call the bot API at the same time: update workers, their
+# typing action timers, privacy lookups, outbox workers (failure notices) and the channel publisher
+BOT_CON_POOL_SIZE = int(os.getenv('BOT_CON_POOL_SIZE') or 2 * MAX_CONCURRENT_UPDATES + PRIVACY_LOOKUP_WORKERS + OUTBOX_WORKERS + 1)
 
 # BOOKING PARAMETERS
 COMPANIES = ujson.loads(os.environ['COMPANIES'])
 FACILITIES = ujson.loads(os.environ['FACILITIES'])
 ALT_FACILITIES = ujson.loads(os.getenv('ALT_FACILITIES') or '{}')
+OPENING_TIME = os.getenv('OPENING_TIME') or '07:00' # HH:MM, bounds suggested time slots
+CLOSING_TIME = os.getenv('CLOSING_TIME') or '22:00'
+BOOKING_HORIZON_DAYS = int(os.getenv('BOOKING_HORIZON_DAYS') or 90) # how far ahead /check lists a facility's bookings
+RESERVATION_STALE_AFTER = int(os.getenv('RESERVATION_STALE_AFTER') or 600) # seconds before a reservation without a calendar event may be cleared
+SUGGESTED_SLOTS = int(os.getenv('SUGGESTED_SLOTS') or 3)
 IANA_TIMEZONE_NAME = os.getenv('IANA_TIMEZONE_NAME') or 'Asia/Singapore'
 TIMEZONE = ZoneInfo(IANA_TIMEZONE_NAME)
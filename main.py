@@ -1,8 +1,10 @@
-import logging
-from telegram import Bot, BotCommandScopeChat, ChatAdministratorRights
+import logging, time
+from queue import Queue
 from telegram.ext import Updater
 from commands import start, help, book, change, check, mybookings, admin
-from utilities import database
+from utilities import calendar, database, metrics, shared, startup
+from utilities.dispatch import ConcurrentDispatcher
+from utilities.persistence import PostgresPersistence
 import config
 
 # Enable logging
@@ -10,18 +12,28 @@ logging.basicConfig(
     format = '[%(levelname)s/%(name)s] %(message)s', 
     level = logging.INFO
 )
+logger = logging.getLogger(__name__)
 
 def main():
     
-    # Create users database if it doesn't exist
+    started = time.perf_counter()
+    # CPU time so far: interpreter startup, imports and module-level setup, but not time spent waiting on disk.
+    # benchmarks/imports.py measures import time itself.
+    cpu_seconds = time.process_time()
+    metrics.set_gauge('startup.pre_main_cpu_seconds', cpu_seconds)
+    logger.info('CPU time before main: %.2fs', cpu_seconds)
+
+    # Create database tables if they don't exist, and clear out reservations for past bookings
     database.create_if_not_exists()
+    database.prune_reservations()
 
     # Initialise bot and updater
-    bot = Bot(config.BOT_TOKEN)
-    updater = Updater(config.BOT_TOKEN)
+    bot = shared.bot
+    persistence = PostgresPersistence(flush_interval = config.PERSISTENCE_FLUSH_INTERVAL) # conversations survive restarts
+    dispatcher = ConcurrentDispatcher(bot, Queue(), persistence = persistence, max_in_flight = config.MAX_CONCURRENT_UPDATES)
+    updater = Updater(dispatcher = dispatcher, workers = None) # workers belong to the dispatcher
 
     # Attach handlers
-    dispatcher = updater.dispatcher
     dispatcher.add_handler(book.handler, 0)
     dispatcher.add_handler(change.handler, 1)
     dispatcher.add_handler(check.handler, 2)
@@ -30,33 +42,16 @@ def main():
     dispatcher.add_handler(help.handler, 5)
     dispatcher.add_handler(start.handler, 6)
         
-    # Configure bot commands
-    default_commands = config.COMMANDS_BOOKING + config.COMMANDS_SETTING
-    admin_commands = config.COMMANDS_ADMIN + default_commands
-    bot.set_my_commands(default_commands)
-    for admin_uid in config.ADMIN_USERS:
-        bot.set_my_commands(admin_commands, scope = BotCommandScopeChat(admin_uid))
-    
-    # Update admin users
-    db_admin_users = database.retrieve_admins()
-    for user_id in db_admin_users - config.ADMIN_USERS:
-        bot.delete_my_commands(BotCommandScopeChat(user_id))
-    for user_id in db_admin_users ^ config.ADMIN_USERS:
-        database.toggle_admin(user_id)
-    
-    # Configure default bot admin rights for facilities log channel
-    rights = ChatAdministratorRights(
-        is_anonymous = False,
-        can_manage_chat = False,
-        can_delete_messages = False,
-        can_manage_video_chats = False,
-        can_restrict_members = False,
-        can_promote_members = False,
-        can_change_info = False,
-        can_invite_users = False,
-        can_post_messages = True
-    )
-    bot.set_my_default_administrator_rights(rights, for_channels = True)
+    # Configure bot commands, admin users and channel admin rights, skipping what is already applied
+    startup.apply_bot_configuration(bot)
+
+    # Keep the Calendar access token fresh, start mirroring the bookings calendar and writing queued bookings to it
+    calendar.start_token_refresher()
+    calendar.mirror.start()
+    calendar.outbox.start()
+
+    # Periodically log handler latencies and other metrics
+    metrics.start_reporter(config.METRICS_LOG_INTERVAL)
 
     # Run bot
     updater.start_webhook(
@@ -65,7 +60,20 @@ def main():
         url_path = config.BOT_TOKEN,
         webhook_url = config.WEBHOOK_URL
     )
+    startup_seconds = time.perf_counter() - started
+    metrics.set_gauge('startup.seconds', startup_seconds)
+    logger.info('Startup took %.2fs', startup_seconds)
     updater.idle()
 
+    # Write conversation state changed since the last flush
+    persistence.flush()
+
+    # Let booking jobs and channel posts in progress finish; the rest stay in the outbox
+    calendar.outbox.stop()
+
+    # Write queued username changes and release pooled database connections
+    database.flush_username_updates()
+    database.close_pool()
+
 if __name__ == '__main__':
     main()
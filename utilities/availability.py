@@ -0,0 +1,40 @@
+'''
+MINUTE-RESOLUTION OCCUPANCY BITMAPS
+A facility's day is an int whose bit n is set if minute n (since midnight)
+is booked, so range checks across facilities are single bitwise operations.
+'''
+MINUTES_PER_DAY = 24 * 60
+
+
+def range_mask(start: int, end: int) -> int:
+    # Bits start..end-1 set
+    return ((1 << (end - start)) - 1) << start if end > start else 0
+
+
+def occupancy_bitmap(spans) -> int:
+
+    bitmap = 0
+    for start, end in spans:
+        bitmap |= range_mask(start, end)
+    return bitmap
+
+
+def is_free(bitmap: int, start: int, end: int) -> bool:
+    return not bitmap & range_mask(start, end)
+
+
+# Start of the first run of `duration` free minutes in [earliest, latest), or None
+def first_free_start(bitmap: int, duration: int, earliest: int = 0, latest: int = MINUTES_PER_DAY):
+
+    runs = ~bitmap & range_mask(earliest, latest)
+
+    # Bit n stays set only while minutes n..n+length-1 are all free; double length each pass
+    length = 1
+    while runs and length < duration:
+        step = min(length, duration - length)
+        runs &= runs >> step
+        length += step
+
+    if not runs:
+        return None
+    return (runs & -runs).bit_length() - 1
@@ -0,0 +1,65 @@
+import logging, time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+'''
+CIRCUIT BREAKER
+After `failure_threshold` consecutive failures the circuit opens and calls
+fail immediately with CircuitOpen. After `reset_timeout` seconds one trial
+call is let through: success closes the circuit, failure reopens it.
+Errors for which `is_failure` returns False (e.g. 404) don't count.
+'''
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float, is_failure = lambda error: True):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self._failures = 0
+        self._opened_at = None # monotonic time the circuit opened, None while closed
+        self._trial_running = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def call(self, func, *args, **kwargs):
+
+        with self._lock:
+            if self._opened_at is not None:
+                if self._trial_running or time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpen(f'{self.name} circuit is open')
+                self._trial_running = True # half-open: let this call through
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            self._record(failed = self.is_failure(error))
+            raise
+        self._record(failed = False)
+        return result
+
+    def _record(self, failed: bool) -> None:
+
+        with self._lock:
+            self._trial_running = False
+            if not failed:
+                if self._opened_at is not None:
+                    logger.info('%s circuit closed', self.name)
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning('%s circuit opened after %s failures', self.name, self._failures)
+                self._opened_at = time.monotonic()
+        return
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+import time
+from utilities import metrics
+
+'''
+BOUNDED LRU CACHE WITH PER-ENTRY EXPIRY
+Values are copied on the way in and out so callers can't mutate cached entries.
+Hits and misses are counted as the metrics {name}.hits and {name}.misses.
+'''
+class TTLCache:
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expiry, value), least recently used first
+        self._lock = Lock()
+
+    def get(self, key, default = None):
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                metrics.increment(f'{self.name}.misses')
+                return default
+            self._entries.move_to_end(key)
+            value = deepcopy(entry[1])
+        metrics.increment(f'{self.name}.hits')
+        return value
+
+    # Whether an unexpired entry exists, without counting a hit or miss
+    def __contains__(self, key) -> bool:
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def set(self, key, value) -> None:
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+        return
+
+    # Apply changes to an entry only if it is already cached
+    def update(self, key, changes: dict) -> None:
+
+        with self._lock:
+            if (entry := self._entries.get(key)):
+                entry[1].update(changes)
+        return
+
+    def pop(self, key) -> None:
+
+        with self._lock:
+            self._entries.pop(key, None)
+        return
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._entries.clear()
+        return
@@ -1,46 +1,250 @@
-from datetime import datetime
-import logging, sys
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from telegram import Bot
-from utilities import shared
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import hashlib, logging, sys, threading, time
+from uuid import uuid4
+from utilities import database, metrics, shared
+from utilities.availability import first_free_start, is_free
+from utilities.breaker import CircuitBreaker, CircuitOpen
+from utilities.intervals import from_minutes, to_minutes
+from utilities.mirror import BookingsMirror
+from utilities.outbox import Outbox
+from utilities.throttle import ThrottleTimeout, TokenBucket
 import config
 
 logger = logging.getLogger(__name__)
 
 '''
 ACCESS CALENDAR API
+The Google client libraries are slow to import, so they are loaded and the
+service is built on first use rather than at startup. The mirror's first
+sync does this in the background.
 '''
+credentials = None
+service = None
+service_lock = threading.RLock()
+
+
 # Authenticate service account
-credentials = service_account.Credentials.from_service_account_info(
-    info = config.SERVICE_ACCOUNT_INFO,
-    scopes = ['https://www.googleapis.com/auth/calendar.events']
+def get_credentials():
+
+    global credentials
+    if credentials is None:
+        with service_lock:
+            if credentials is None:
+                from google.oauth2 import service_account
+                credentials = service_account.Credentials.from_service_account_info(
+                    info = config.SERVICE_ACCOUNT_INFO,
+                    scopes = ['https://www.googleapis.com/auth/calendar.events']
+                )
+    return credentials
+
+
+# Create service object from the discovery document bundled with the client library, without fetching it
+def get_service():
+
+    global service
+    if service is None:
+        with service_lock:
+            if service is None:
+                started = time.perf_counter()
+                from googleapiclient.discovery import build
+                service = build('calendar', 'v3', credentials = get_credentials(), static_discovery = True)
+                metrics.observe('calendar.service_build', time.perf_counter() - started)
+                logger.info('Calendar service built in %.2fs', time.perf_counter() - started)
+    return service
+
+
+# httplib2 is not thread-safe, so each thread executes requests over its own connection
+thread_local = threading.local()
+
+def execute(request):
+
+    if not hasattr(thread_local, 'http'):
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        thread_local.http = AuthorizedHttp(get_credentials(), http = httplib2.Http(timeout = config.CALENDAR_TIMEOUT))
+    throttle('read' if request.method == 'GET' else 'write')
+    try:
+        return breaker.call(request.execute, http = thread_local.http)
+    except Exception as error:
+        if http_status(error) in (403, 429) and is_retryable(error): # over quota despite the limiter
+            quota_bucket.drain()
+        raise
+
+
+'''
+RATE LIMITS
+Reads and writes each have their own budget, and both draw on the shared
+per-user quota, where queued writes are served before reads. A request that
+can't get a token within CALENDAR_THROTTLE_TIMEOUT seconds fails with
+ThrottleTimeout rather than queueing indefinitely.
+'''
+read_bucket = TokenBucket(rate = config.CALENDAR_READS_PER_SECOND, capacity = config.CALENDAR_READS_PER_SECOND)
+write_bucket = TokenBucket(rate = config.CALENDAR_WRITES_PER_SECOND, capacity = config.CALENDAR_WRITES_PER_SECOND)
+quota_bucket = TokenBucket(rate = config.CALENDAR_QUOTA_PER_SECOND, capacity = config.CALENDAR_QUOTA_PER_SECOND)
+
+
+def throttle(kind: str) -> None:
+
+    started = time.monotonic()
+    bucket = write_bucket if kind == 'write' else read_bucket
+    acquired = bucket.acquire(config.CALENDAR_THROTTLE_TIMEOUT) is not None
+    if acquired and quota_bucket.acquire(config.CALENDAR_THROTTLE_TIMEOUT - (time.monotonic() - started), priority = kind == 'write') is None:
+        bucket.release() # the request isn't sent, so it mustn't count against the budget
+        acquired = False
+    if not acquired:
+        metrics.increment(f'calendar.throttled.{kind}')
+        raise ThrottleTimeout(f'Google Calendar {kind} rate limit reached')
+    metrics.observe(f'calendar.throttle_wait.{kind}', time.monotonic() - started)
+    return
+
+
+def http_status(error):
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+# Rate limits, server errors and dropped connections are worth another attempt
+def is_retryable(error) -> bool:
+
+    import httplib2
+    from google.auth.exceptions import TransportError
+    if isinstance(error, ThrottleTimeout):
+        return True
+    if (status := http_status(error)) is not None:
+        if status == 403:
+            return 'ateLimitExceeded' in str(getattr(error, 'content', '')) # rateLimitExceeded or userRateLimitExceeded
+        return status == 429 or status >= 500
+    return isinstance(error, (OSError, httplib2.HttpLib2Error, TransportError))
+
+
+# While Google is failing, calls fail fast with CircuitOpen instead of waiting out the timeout
+breaker = CircuitBreaker(
+    'Google Calendar',
+    failure_threshold = config.CALENDAR_BREAKER_THRESHOLD,
+    reset_timeout = config.CALENDAR_BREAKER_RESET,
+    is_failure = is_retryable
 )
 
-# Create service object
-try:
-    service = build('calendar', 'v3', credentials = credentials)
-except HttpError as error:
-    service = None
-    logger.exception(error)
+
+'''
+TOKEN REFRESH
+Access tokens are renewed in the background CALENDAR_TOKEN_REFRESH_MARGIN
+seconds before they expire, so requests never wait on Google's token
+endpoint. Requests still refresh on demand if the refresher falls behind.
+'''
+token_refreshed_at = None # monotonic time of the last successful refresh
+token_thread = None
+
+
+def refresh_credentials() -> None:
+
+    global token_refreshed_at
+    import httplib2
+    from google_auth_httplib2 import Request
+    started = time.perf_counter()
+    get_credentials().refresh(Request(httplib2.Http(timeout = config.CALENDAR_TIMEOUT)))
+    token_refreshed_at = time.monotonic()
+    metrics.observe('calendar.token_refresh', time.perf_counter() - started)
+    return
+
+
+# Seconds until the current token is due for renewal
+def seconds_until_refresh() -> float:
+
+    if (expiry := get_credentials().expiry) is None or token_refreshed_at is None:
+        return 0
+    return (expiry - datetime.utcnow()).total_seconds() - config.CALENDAR_TOKEN_REFRESH_MARGIN
+
+
+def token_refresh_worker() -> None:
+
+    while True:
+        try:
+            if seconds_until_refresh() <= 0:
+                refresh_credentials()
+            metrics.set_gauge('calendar.token_age', time.monotonic() - token_refreshed_at)
+            delay = min(max(seconds_until_refresh(), 1), 60) # wake at least every minute to update the token age
+        except Exception as error:
+            logger.warning('Calendar Token Refresh Failure - %s', error)
+            metrics.increment('calendar.token_refresh_failures')
+            delay = config.CALENDAR_TOKEN_RETRY_INTERVAL
+        time.sleep(delay)
+
+
+def start_token_refresher() -> None:
+
+    global token_thread
+    if token_thread is None:
+        token_thread = threading.Thread(target = token_refresh_worker, name = 'calendar-token-refresh', daemon = True)
+        token_thread.start()
+    return
+
+
+# Partial responses: only the event fields the bot reads
+EVENT_FIELDS = 'id,status,htmlLink,extendedProperties/shared'
+LIST_FIELDS = f'nextPageToken,nextSyncToken,items({EVENT_FIELDS})'
+
+'''
+BOOKINGS MIRROR
+'''
+def list_events_page(sync_token: str = None, page_token: str = None) -> dict:
+
+    return execute(get_service().events().list(
+        calendarId = config.CALENDAR_ID,
+        singleEvents = True, # must match across a sync token's lifetime
+        syncToken = sync_token,
+        pageToken = page_token,
+        maxResults = config.CALENDAR_PAGE_SIZE,
+        fields = LIST_FIELDS
+    ))
+
+# Changes still in the outbox, as the mirror shows them until they are written
+def pending_bookings() -> dict:
+
+    pending = {}
+    for job in database.retrieve_outbox_jobs():
+        if job['action'] == 'post': # already written to the calendar
+            continue
+        if job['action'] == 'delete':
+            pending[job['event_id']] = (job['job_id'], None)
+        else:
+            previous_event = (job['rollback'] or {}).get('event')
+            pending[job['event_id']] = (job['job_id'], pending_event(job['event_id'], job['body'], previous_event and previous_event['htmlLink']))
+    return pending
+
+
+mirror = BookingsMirror(fetch_page = list_events_page, interval = config.CALENDAR_SYNC_INTERVAL, fetch_pending = pending_bookings)
+
+'''
+STALE READS
+Bookings are read from the mirror, so while Google is unreachable replies
+come from the last successful sync and say how old it is.
+'''
+def stale_notice() -> str:
+
+    if mirror.last_synced is None:
+        return ''
+    age = time.monotonic() - mirror.last_synced
+    if not breaker.is_open and age < config.CALENDAR_STALE_AFTER:
+        return ''
+    metrics.increment('calendar.stale_reads')
+    synced_at = datetime.now(config.TIMEZONE) - timedelta(seconds = age)
+    return f"⚠ Google Calendar can't be reached right now, so this is as of {synced_at.strftime('%H:%M')} and may be out of date.\n\n"
+
 
 '''
 LIST BOOKINGS
 '''
 def find_bookings_for_facility_by_date(facility: str, date: str) -> list:
     
-    utc_offset = datetime.now(config.TIMEZONE).isoformat()[26:]
-    bookings = service.events().list(
-        calendarId = config.CALENDAR_ID,
-        orderBy = 'startTime', # assumed by list_available_slots()
-        singleEvents = True, # requirement for ordering by start time
-        timeMin = f'{date}T00:00:00{utc_offset}', # exclusive bound
-        timeMax = f'{date}T23:59:59{utc_offset}', # exclusive bound
-        sharedExtendedProperty = f'facility={facility}',
-    ).execute()
+    return mirror.bookings_for_facility_by_date(facility, date) # ordered by start time, assumed by list_available_slots()
 
-    return bookings['items']
+
+def get_booking(event_id: str) -> dict:
+
+    if (booking := mirror.get(event_id)):
+        return booking
+    return execute(get_service().events().get(calendarId = config.CALENDAR_ID, eventId = event_id, fields = EVENT_FIELDS))
 
 
 def find_ongoing_or_next(bookings_today: list, current_time: datetime.time):
@@ -82,117 +286,201 @@ def find_ongoing_or_next(bookings_today: list, current_time: datetime.time):
     return
 
 
-def find_upcoming_bookings_by_user(user_id: int) -> list:
+# Bookings from today, up to `horizon_days` ahead or all of them, ordered by start time
+def iter_upcoming_bookings(field: str, value: str, horizon_days: int = None):
+
+    now = datetime.now(config.TIMEZONE)
+    to_date = (now + timedelta(days = horizon_days)).strftime('%Y-%m-%d') if horizon_days is not None else '\uffff'
+    yield from mirror.iter_bookings(field, value, now.strftime('%Y-%m-%d'), to_date)
+
+
+# Split bookings ordered by start time into ongoing, later today and after today
+def split_upcoming_bookings(bookings: list) -> dict:
 
     now = datetime.now(config.TIMEZONE)
-    utc_offset = now.isoformat()[26:]
     current_date = now.strftime('%Y-%m-%d')
-    current_time = now.time()
+    current_time = now.strftime('%H:%M:%S') # 'HH:MM' sorts before 'HH:MM:SS' of the same minute
 
-    bookings = service.events().list(
-        calendarId = config.CALENDAR_ID,
-        orderBy = 'startTime',
-        singleEvents = True,
-        timeMin = f'{current_date}T00:00:00{utc_offset}',
-        sharedExtendedProperty = f'user_id={user_id}',
-    ).execute()['items']
+    start_keys = [
+        (booking['extendedProperties']['shared']['date'], booking['extendedProperties']['shared']['start_time'])
+        for booking in bookings
+    ]
+    tomorrow_idx = bisect_right(start_keys, (current_date, '\uffff'))
+    later_today_idx = bisect_right(start_keys, (current_date, current_time), 0, tomorrow_idx)
 
-    result = {'ongoing': [], 'later_today': [], 'after_today': []}
+    return {
+        'ongoing': [
+            booking for booking in bookings[:later_today_idx]
+            if booking['extendedProperties']['shared']['end_time'] >= current_time
+        ],
+        'later_today': bookings[later_today_idx:tomorrow_idx],
+        'after_today': bookings[tomorrow_idx:]
+    }
 
-    remainder_idx = None
 
-    for idx, booking in enumerate(bookings):
-        booking_details = booking['extendedProperties']['shared']
-        if booking_details['date'] == current_date:
+def find_upcoming_bookings_by_user(user_id: int) -> dict:
+    return split_upcoming_bookings(list(iter_upcoming_bookings('user_id', str(user_id))))
 
-            start_time = datetime.strptime(booking_details['start_time'], '%H:%M').time()
-            end_time = datetime.strptime(booking_details['end_time'], '%H:%M').time()
 
-            if start_time <= current_time and end_time >= current_time:
-                result['ongoing'].append(booking)
+def find_upcoming_bookings_by_facility(facility: str) -> dict:
+    return split_upcoming_bookings(list(iter_upcoming_bookings('facility', facility, config.BOOKING_HORIZON_DAYS)))
 
-            elif start_time > current_time:
-                result['later_today'].append(booking)
 
-        else: # Since bookings are arranged by start time, all subsequent items are after today
-            result['after_today'].append(booking)
-            remainder_idx = idx + 1
-            break
+'''
+DECONFLICT BOOKINGS
+'''
+def list_conflicts(chat_data: dict, facility = None) -> list:
 
-    if remainder_idx:
-        result['after_today'] += bookings[remainder_idx:]
+    target_facility = facility or chat_data['facility'] # optionally specify facility, supports alt facility functionality
+    return list_conflicts_by_facility(chat_data, [target_facility])[target_facility]
 
-    return result
 
+# Check several facilities against the same date and time range in one pass
+def list_conflicts_by_facility(chat_data: dict, facilities: list) -> dict:
 
-def find_upcoming_bookings_by_facility(facility: str) -> list:
+    return mirror.overlapping_bookings(
+        facilities,
+        chat_data['date'],
+        to_minutes(chat_data['start_time']),
+        to_minutes(chat_data['end_time'])
+    )
 
-    now = datetime.now(config.TIMEZONE)
-    utc_offset = now.isoformat()[26:]
-    current_date = now.strftime('%Y-%m-%d')
-    current_time = now.time()
 
-    bookings = service.events().list(
-        calendarId = config.CALENDAR_ID,
-        orderBy = 'startTime',
-        singleEvents = True,
-        timeMin = f'{current_date}T00:00:00{utc_offset}',
-        sharedExtendedProperty = f'facility={facility}'
-    ).execute()['items']
+'''
+FIND AVAILABLE SLOTS
+'''
+# Free gaps in minutes since midnight, within operating hours and not in the past
+def find_free_gaps(facility: str, date: str, min_duration: int, opening_time: str, closing_time: str) -> list:
 
-    result = {'ongoing': [], 'later_today': [], 'after_today': []}
-    remainder_idx = None
+    opening = to_minutes(opening_time)
+    closing = to_minutes(closing_time)
+    now = datetime.now(config.TIMEZONE)
+    if date == now.strftime('%Y-%m-%d'):
+        opening = max(opening, -(-(now.hour * 60 + now.minute) // 5) * 5) # round up to 5 minutes
 
-    for idx, booking in enumerate(bookings):
+    gaps = []
+    cursor = opening
+    for booking in find_bookings_for_facility_by_date(facility, date): # ordered by start time
         booking_details = booking['extendedProperties']['shared']
-        if booking_details['date'] == current_date:
+        start = min(to_minutes(booking_details['start_time']), closing)
+        if start - cursor >= min_duration:
+            gaps.append((cursor, start))
+        cursor = max(cursor, to_minutes(booking_details['end_time']))
+    if closing - cursor >= min_duration:
+        gaps.append((cursor, closing))
+
+    return gaps
+
+
+def list_available_slots(
+    facility: str,
+    date: str,
+    min_duration: int = 0,
+    opening_time: str = config.OPENING_TIME,
+    closing_time: str = config.CLOSING_TIME
+) -> list:
+
+    return [
+        (from_minutes(start), from_minutes(end))
+        for start, end in find_free_gaps(facility, date, max(min_duration, 1), opening_time, closing_time)
+    ]
 
-            start_time = datetime.strptime(booking_details['start_time'], '%H:%M').time()
-            end_time = datetime.strptime(booking_details['end_time'], '%H:%M').time()
 
-            if start_time <= current_time and end_time >= current_time:
-                result['ongoing'].append(booking)
+# Free slots as long as the requested time range, closest to it first
+def suggest_slots(facility: str, date: str, start_time: str, end_time: str, count: int = config.SUGGESTED_SLOTS) -> list:
 
-            elif start_time > current_time:
-                result['later_today'].append(booking)
+    start = to_minutes(start_time)
+    duration = to_minutes(end_time) - start
+    candidates = [
+        min(max(start, gap_start), gap_end - duration) # nearest start within each gap
+        for gap_start, gap_end in find_free_gaps(facility, date, duration, config.OPENING_TIME, config.CLOSING_TIME)
+    ]
+    candidates = sorted(sorted(candidates, key = lambda candidate: abs(candidate - start))[:count])
 
-        else: # Since bookings are arranged by start time, all subsequent items are after today
-            result['after_today'].append(booking)
-            remainder_idx = idx + 1
-            break
+    return [(from_minutes(candidate), from_minutes(candidate + duration)) for candidate in candidates]
 
-    if remainder_idx:
-        result['after_today'] += bookings[remainder_idx:]
 
-    return result
+# Facilities with no bookings in the time range
+def find_free_facilities(date: str, start_time: str, end_time: str, facilities: list = config.FACILITIES) -> list:
+
+    start = to_minutes(start_time)
+    end = to_minutes(end_time)
+    occupancy = mirror.occupancy(facilities, date)
+    return [facility for facility in facilities if is_free(occupancy[facility], start, end)]
+
+
+# First free range of each facility at least as long as the given duration, or None
+def find_first_free_ranges(date: str, duration: int, earliest_time: str = config.OPENING_TIME, facilities: list = config.FACILITIES) -> dict:
+
+    earliest = to_minutes(earliest_time)
+    latest = to_minutes(config.CLOSING_TIME)
+    now = datetime.now(config.TIMEZONE)
+    if date == now.strftime('%Y-%m-%d'):
+        earliest = max(earliest, now.hour * 60 + now.minute)
+
+    free_ranges = {}
+    for facility, bitmap in mirror.occupancy(facilities, date).items():
+        start = first_free_start(bitmap, duration, earliest, latest)
+        free_ranges[facility] = (from_minutes(start), from_minutes(start + duration)) if start is not None else None
+    return free_ranges
 
 
 '''
-DECONFLICT BOOKINGS
+RESERVATIONS
+The bookings table in Postgres decides which of two concurrent bookings for
+the same slot goes ahead, before either is written to the calendar. Admin
+bookings may overlap others and hold no reservation, so user bookings are
+also checked against the mirror, where admin bookings appear immediately.
 '''
-def list_conflicts(chat_data: dict, facility = None) -> list:
+class BookingConflict(Exception):
+    pass
+
+
+def booking_period(date: str, start_time: str, end_time: str) -> tuple:
+
+    start = datetime.strptime(f'{date} {start_time}', '%Y-%m-%d %H:%M').replace(tzinfo = config.TIMEZONE)
+    end = datetime.strptime(f'{date} {end_time}', '%Y-%m-%d %H:%M').replace(tzinfo = config.TIMEZONE)
+    return start, end
 
-    target_facility = facility or chat_data['facility'] # optionally specify facility, supports alt facility functionality
-    existing_bookings = find_bookings_for_facility_by_date(target_facility, chat_data['date'])
 
-    conflicts = []
-    for booking in existing_bookings:
+# Record a job together with its event's reservation, clearing reservations left behind by events
+# deleted in the calendar or by abandoned jobs; returns the job_id
+def reserve_and_enqueue(job: dict, facility: str, date: str, start_time: str, end_time: str) -> int:
 
-        datetime_start_time = datetime.strptime(booking['extendedProperties']['shared']['start_time'], '%H:%M').time()
-        datetime_end_time = datetime.strptime(booking['extendedProperties']['shared']['end_time'], '%H:%M').time()
+    # Catch admin bookings made since the user's conflict check
+    overlapping = mirror.overlapping_bookings([facility], date, to_minutes(start_time), to_minutes(end_time))[facility]
+    if any(event['id'] != job['event_id'] for event in overlapping):
+        metrics.increment('reservations.conflicts')
+        raise BookingConflict(f'{facility} is already booked on {date} between {start_time} and {end_time}')
 
-        if (
-            (chat_data['datetime_start_time'] > datetime_start_time and chat_data['datetime_start_time'] < datetime_end_time)
-            or (chat_data['datetime_end_time'] > datetime_start_time and chat_data['datetime_end_time'] < datetime_end_time)
-            or (chat_data['datetime_start_time'] <= datetime_start_time and chat_data['datetime_end_time'] >= datetime_end_time)
-        ):
-            conflicts.append(booking)
+    start, end = booking_period(date, start_time, end_time)
+    if (job_id := database.enqueue_booking_job(job, reservation = (facility, start, end))) is not None:
+        return job_id
 
-    return conflicts
+    overlapping = database.retrieve_overlapping_reservations(facility, start, end, job['event_id'])
+    stale = [
+        overlapping_id for overlapping_id, confirmed, age, queued in overlapping
+        if age > config.RESERVATION_STALE_AFTER and not queued and not (confirmed and mirror.get(overlapping_id))
+    ]
+    if len(stale) == len(overlapping):
+        if stale:
+            logger.info('Releasing Stale Reservations - %s', stale)
+            database.release_reservations(stale)
+            database.prune_reservations()
+        if (job_id := database.enqueue_booking_job(job, reservation = (facility, start, end))) is not None:
+            return job_id
+
+    metrics.increment('reservations.conflicts')
+    raise BookingConflict(f'{facility} is already booked on {date} between {start_time} and {end_time}')
 
 
 '''
 MAKE/CHANGE/DELETE BOOKINGS
+Changes are recorded in the outbox and applied to the mirror straight away;
+outbox workers then write them to the calendar and post them to the
+channel, retrying both until they succeed. Callers wait up to
+OUTBOX_CONFIRM_WAIT seconds for the event link and get None if it isn't
+ready yet.
 '''
 def generate_event_colorid(company: str) -> int:
     ColorId = config.COMPANIES.index(company) + 1
@@ -201,138 +489,307 @@ def generate_event_colorid(company: str) -> int:
     return ColorId
 
 
-def add_booking(user_id: int, user_data: dict, chat_data: dict, update_channel = True) -> str:
+# href attribute linking to a POC's Telegram profile, if they allow it
+def generate_chat_link(user_id: int, username: str) -> str:
+    
+    if username != 'NULL':
+        return f" href='https://t.me/{username}'"
+    if shared.has_private_forwards(user_id):
+        return " href=''"
+    return f" href='tg://user?id={user_id}'"
+
+
+# Same booking request, same event id, so a retried insert can't create a duplicate
+def generate_event_id(user_id: int, chat_data: dict) -> str:
+
+    nonce = chat_data.setdefault('booking_nonce', uuid4().hex) # set afresh when a conversation starts
+    key = f"{user_id}|{chat_data['facility']}|{chat_data['date']}|{chat_data['start_time']}|{chat_data['end_time']}|{nonce}"
+    return hashlib.sha1(key.encode()).hexdigest() # hex digits are valid in event ids, which use base32hex
+
+
+# Fetch an event whose insert returned 409, i.e. an earlier attempt created it; None if it was since deleted
+def get_inserted_event(event_id: str):
+
+    event = execute(get_service().events().get(calendarId = config.CALENDAR_ID, eventId = event_id, fields = EVENT_FIELDS))
+    return None if event.get('status') == 'cancelled' else event
+
+
+# What the mirror shows until the outbox has written the event
+def pending_event(event_id: str, body: dict, html_link: str = None) -> dict:
+
+    return {
+        'id': event_id,
+        'status': 'confirmed',
+        'htmlLink': html_link or config.CALENDAR_URL,
+        'extendedProperties': body['extendedProperties']
+    }
+
+
+# Channel post details; the POC link and event link are added when the post is sent
+def channel_details(title: str, user_id: int, user_data: dict, details: str) -> dict:
+
+    return {
+        'title': title,
+        'details': details,
+        'user_id': user_id,
+        'username': user_data['username'],
+        'poc': f"{user_data['rank_and_name']} ({user_data['company']})"
+    }
+
+
+def channel_post(channel: dict, html_link) -> str:
+
+    chat_link = generate_chat_link(channel['user_id'], channel['username'])
+    title = f'<b><a href="{html_link}">{channel["title"]}</a></b>' if html_link else f"<b>{channel['title']}</b>"
+    return f"{title}\n{channel['details']}<b>POC</b>: <a{chat_link}>{channel['poc']}</a>"
+
+
+# Admin bookings may overlap others, so they pass reserve_slot = False
+def add_booking(user_id: int, user_data: dict, chat_data: dict, update_channel = True, reserve_slot = True, notify_chat_id: int = None):
     
+    event_id = generate_event_id(user_id, chat_data)
     utc_offset = datetime.now(config.TIMEZONE).isoformat()[26:]
-    new_booking = service.events().insert(
-        calendarId = config.CALENDAR_ID,
-        body = {
-            "summary": f"{chat_data['facility']} ({user_data['company']})",
-            "description":
-                f"Activity: {chat_data['description']}\n"
-                f"POC: {user_data['rank_and_name']} ({user_data['company']})",
-            "start": {
-                "dateTime": f"{chat_data['date']}T{chat_data['start_time']}:00{utc_offset}",
-                "timeZone": config.IANA_TIMEZONE_NAME,
-            },
-            "end": {
-                "dateTime": f"{chat_data['date']}T{chat_data['end_time']}:00{utc_offset}",
-                "timeZone": config.IANA_TIMEZONE_NAME,
-            },
-            "colorId": generate_event_colorid(user_data['company']),
-            "extendedProperties": {
-                "shared": {
-                   "facility": chat_data["facility"],
-                   "date": chat_data["date"],
-                   "start_time": chat_data["start_time"],
-                   "end_time": chat_data["end_time"],
-                   "description": chat_data["description"],
-                   "name_and_company": f"{user_data['rank_and_name']} ({user_data['company']})",
-                   "user_id": str(user_id),
-                   "username": user_data["username"]
-                },
+    body = {
+        "id": event_id,
+        "summary": f"{chat_data['facility']} ({user_data['company']})",
+        "description":
+            f"Activity: {chat_data['description']}\n"
+            f"POC: {user_data['rank_and_name']} ({user_data['company']})",
+        "start": {
+            "dateTime": f"{chat_data['date']}T{chat_data['start_time']}:00{utc_offset}",
+            "timeZone": config.IANA_TIMEZONE_NAME,
+        },
+        "end": {
+            "dateTime": f"{chat_data['date']}T{chat_data['end_time']}:00{utc_offset}",
+            "timeZone": config.IANA_TIMEZONE_NAME,
+        },
+        "colorId": generate_event_colorid(user_data['company']),
+        "extendedProperties": {
+            "shared": {
+               "facility": chat_data["facility"],
+               "date": chat_data["date"],
+               "start_time": chat_data["start_time"],
+               "end_time": chat_data["end_time"],
+               "description": chat_data["description"],
+               "name_and_company": f"{user_data['rank_and_name']} ({user_data['company']})",
+               "user_id": str(user_id),
+               "username": user_data["username"]
             },
-        }
-    ).execute()
-
-    if update_channel:
-        if user_data['username'] == 'NULL':
-            if Bot(config.BOT_TOKEN).get_chat(user_id).has_private_forwards:
-                chat_link = " href=''"
-            else:
-                chat_link = f" href='tg://user?id={user_id}'"
-        else:
-            chat_link = f" href='https://t.me/{user_data['username']}'"
-        shared.update_facilities_channel(
-            f'<b><a href="{new_booking["htmlLink"]}">New Booking</a></b>\n'
+        },
+    }
+
+    job = {
+        'event_id': event_id,
+        'action': 'insert',
+        'body': body,
+        'channel': channel_details(
+            'New Booking', user_id, user_data,
             f"<b>Facility</b>: {chat_data['facility']}\n"
             f"<b>Date</b>: {chat_data['date']}\n"
             f"<b>Time</b>: {chat_data['start_time']} - {chat_data['end_time']}\n"
             f"<b>Description</b>: {chat_data['description']}\n"
-            f"<b>POC</b>: <a{chat_link}>{user_data['rank_and_name']} ({user_data['company']})</a>"
-        )
+        ) if update_channel else None,
+        'rollback': None,
+        'chat_id': notify_chat_id,
+        'failure_notice':
+            f"⚠ Sorry, your booking of {chat_data['facility']} on {chat_data['date']}, "
+            f"{chat_data['start_time']} - {chat_data['end_time']} could not be saved to Google Calendar. Send /book to try again."
+    }
+    if reserve_slot:
+        job_id = reserve_and_enqueue(job, chat_data['facility'], chat_data['date'], chat_data['start_time'], chat_data['end_time'])
+    else:
+        job_id = database.enqueue_booking_job(job)
+    mirror.apply(pending_event(event_id, body), job_id = job_id)
 
-    return new_booking['htmlLink']
+    return outbox.wait(job_id, config.OUTBOX_CONFIRM_WAIT)
 
 
-def patch_booking(user_id: int, user_data: dict, chat_data: dict) -> str:
+def patch_booking(user_id: int, user_data: dict, chat_data: dict, notify_chat_id: int = None):
     
     now = datetime.now(config.TIMEZONE)
     utc_offset = now.isoformat()[26:]
     patch_timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
-    patched_booking = service.events().patch(
-        calendarId = config.CALENDAR_ID,
-        eventId = chat_data['event_id'],
-        body = {
-            "summary": f"{chat_data['facility']} ({user_data['company']})",
-            "description":
-                f"Activity: {chat_data['description']}\n"
-                f"POC: {user_data['rank_and_name']} ({user_data['company']})\n\n"
-                f"Edited on {patch_timestamp}",
-            "start": {
-                "dateTime": f"{chat_data['date']}T{chat_data['start_time']}:00{utc_offset}",
-                "timeZone": config.IANA_TIMEZONE_NAME,
-            },
-            "end": {
-                "dateTime": f"{chat_data['date']}T{chat_data['end_time']}:00{utc_offset}",
-                "timeZone": config.IANA_TIMEZONE_NAME,
+    body = {
+        "summary": f"{chat_data['facility']} ({user_data['company']})",
+        "description":
+            f"Activity: {chat_data['description']}\n"
+            f"POC: {user_data['rank_and_name']} ({user_data['company']})\n\n"
+            f"Edited on {patch_timestamp}",
+        "start": {
+            "dateTime": f"{chat_data['date']}T{chat_data['start_time']}:00{utc_offset}",
+            "timeZone": config.IANA_TIMEZONE_NAME,
+        },
+        "end": {
+            "dateTime": f"{chat_data['date']}T{chat_data['end_time']}:00{utc_offset}",
+            "timeZone": config.IANA_TIMEZONE_NAME,
+        },
+        "colorId": generate_event_colorid(user_data['company']),
+        "extendedProperties": {
+            "shared": {
+               "facility": chat_data["facility"],
+               "date": chat_data["date"],
+               "start_time": chat_data["start_time"],
+               "end_time": chat_data["end_time"],
+               "description": chat_data["description"],
+               "name_and_company": f"{user_data['rank_and_name']} ({user_data['company']})",
+               "user_id": str(user_id),
+               "username": user_data["username"]
             },
-            "colorId": generate_event_colorid(user_data['company']),
-            "extendedProperties": {
-                "shared": {
-                   "facility": chat_data["facility"],
-                   "date": chat_data["date"],
-                   "start_time": chat_data["start_time"],
-                   "end_time": chat_data["end_time"],
-                   "description": chat_data["description"],
-                   "name_and_company": f"{user_data['rank_and_name']} ({user_data['company']})",
-                   "user_id": str(user_id),
-                   "username": user_data["username"]
-                },
-            },
-        }
-    ).execute()
+        },
+    }
+
+    previous_event = mirror.get(chat_data['event_id'])
+    job = {
+        'event_id': chat_data['event_id'],
+        'action': 'patch',
+        'body': body,
+        'channel': channel_details(
+            'Booking Updated', user_id, user_data,
+            f"<b>Facility</b>: {chat_data['old_facility']}{chat_data['facility']}\n"
+            f"<b>Date</b>: {chat_data['old_date']}{chat_data['date']}\n"
+            f"<b>Time</b>: {chat_data['old_start_time']}{chat_data['old_end_time']}{chat_data['start_time']} - {chat_data['end_time']}\n"
+            f"<b>Description</b>: {chat_data['old_description']}{chat_data['description']}\n"
+        ),
+        'rollback': {
+            'event': previous_event,
+            'reservation': [value.isoformat() if isinstance(value, datetime) else value for value in reservation]
+                if (reservation := database.retrieve_reservation(chat_data['event_id'])) else None
+        },
+        'chat_id': notify_chat_id,
+        'failure_notice':
+            f"⚠ Sorry, your change to the {chat_data['facility']} booking on {chat_data['date']} "
+            "could not be saved to Google Calendar, so the booking is unchanged. Send /change to try again."
+    }
+    job_id = reserve_and_enqueue(job, chat_data['facility'], chat_data['date'], chat_data['start_time'], chat_data['end_time'])
+    mirror.apply(pending_event(chat_data['event_id'], body, previous_event and previous_event['htmlLink']), job_id = job_id)
+
+    return outbox.wait(job_id, config.OUTBOX_CONFIRM_WAIT)
+
+
+def delete_booking(user_id: int, user_data: dict, chat_data: dict, notify_chat_id: int = None) -> None:
+
+    reservation = database.retrieve_reservation(chat_data['event_id'])
+    job = {
+        'event_id': chat_data['event_id'],
+        'action': 'delete',
+        'body': None,
+        'channel': channel_details(
+            'Booking Cancelled', user_id, user_data,
+            f"<b>Facility</b>: {chat_data['facility']}\n"
+            f"<b>Date</b>: {chat_data['date']}\n"
+            f"<b>Time</b>: {chat_data['start_time']} - {chat_data['end_time']}\n"
+            f"<b>Description</b>: {chat_data['description']}\n"
+        ),
+        'rollback': {
+            'event': mirror.get(chat_data['event_id']),
+            'reservation': [value.isoformat() if isinstance(value, datetime) else value for value in reservation] if reservation else None
+        },
+        'chat_id': notify_chat_id,
+        'failure_notice':
+            f"⚠ Sorry, your {chat_data['facility']} booking on {chat_data['date']} "
+            "could not be deleted from Google Calendar, so it still stands. Send /change to try again."
+    }
+    job_id = database.enqueue_booking_job(job, release = True)
+    mirror.remove(chat_data['event_id'], job_id = job_id)
+
+    outbox.wait(job_id, config.OUTBOX_CONFIRM_WAIT)
+    return
 
-    if user_data['username'] == 'NULL':
-        if Bot(config.BOT_TOKEN).get_chat(user_id).has_private_forwards:
-            chat_link = " href=''"
-        else:
-            chat_link = f" href='tg://user?id={user_id}'"
+
+'''
+OUTBOX JOBS
+A job writes its change to the calendar, then its row becomes a 'post' step
+that stays in the outbox until the channel post is sent.
+'''
+# Write one recorded change to the calendar, or send a channel post; returns the event link
+def process_booking_job(job: dict):
+
+    event_id = job['event_id']
+    if job['action'] == 'post':
+        publish_channel_posts(job)
+        return None
+    if job['action'] == 'insert':
+        try:
+            event = execute(get_service().events().insert(calendarId = config.CALENDAR_ID, fields = EVENT_FIELDS, body = job['body']))
+        except Exception as error:
+            if http_status(error) != 409 or (event := get_inserted_event(event_id)) is None:
+                raise
+    elif job['action'] == 'patch':
+        event = execute(get_service().events().patch(calendarId = config.CALENDAR_ID, eventId = event_id, fields = EVENT_FIELDS, body = job['body']))
     else:
-        chat_link = f" href='https://t.me/{user_data['username']}'"
-    shared.update_facilities_channel(
-        f'<b><a href="{patched_booking["htmlLink"]}">Booking Updated</a></b>\n'
-        f"<b>Facility</b>: {chat_data['old_facility']}{chat_data['facility']}\n"
-        f"<b>Date</b>: {chat_data['old_date']}{chat_data['date']}\n"
-        f"<b>Time</b>: {chat_data['old_start_time']}{chat_data['old_end_time']}{chat_data['start_time']} - {chat_data['end_time']}\n"
-        f"<b>Description</b>: {chat_data['old_description']}{chat_data['description']}\n"
-        f"<b>POC</b>: <a{chat_link}>{user_data['rank_and_name']} ({user_data['company']})</a>"
-    )
+        try:
+            execute(get_service().events().delete(calendarId = config.CALENDAR_ID, eventId = event_id))
+        except Exception as error:
+            if http_status(error) not in (404, 410): # already deleted, e.g. by an earlier attempt
+                raise
+        event = None
 
-    return patched_booking['htmlLink']
+    if event is not None:
+        database.confirm_reservation(event_id)
+        mirror.apply(event)
+    return event and event['htmlLink']
 
 
-def delete_booking(user_id: int, user_data: dict, chat_data: dict) -> None:
+# A change written to the calendar is followed by its channel post
+def channel_post_step(job: dict, html_link):
 
-    service.events().delete(
-        calendarId = config.CALENDAR_ID,
-        eventId = chat_data['event_id']
-    ).execute()
+    if job['action'] != 'post' and job['channel'] and config.CHANNEL_USERNAME:
+        return 'post', {'text': channel_post(job['channel'], html_link)}
+    return None
 
-    if user_data['username'] == 'NULL':
-        if Bot(config.BOT_TOKEN).get_chat(user_id).has_private_forwards:
-            chat_link = " href=''"
-        else:
-            chat_link = f" href='tg://user?id={user_id}'"
-    else:
-        chat_link = f" href='https://t.me/{user_data['username']}'"
-    shared.update_facilities_channel(
-        "<b>Booking Cancelled</b>\n"
-        f"<b>Facility</b>: {chat_data['facility']}\n"
-        f"<b>Date</b>: {chat_data['date']}\n"
-        f"<b>Time</b>: {chat_data['start_time']} - {chat_data['end_time']}\n"
-        f"<b>Description</b>: {chat_data['description']}\n"
-        f"<b>POC</b>: <a{chat_link}>{user_data['rank_and_name']} ({user_data['company']})</a>"
-    )
 
+# Once CHANNEL_DIGEST_THRESHOLD other posts are due, they go out with this one as a digest
+def publish_channel_posts(job: dict) -> None:
+
+    backlog = database.claim_outbox_jobs(config.OUTBOX_LEASE, config.CHANNEL_DIGEST_MAX_POSTS - 1, 'post')
+    if backlog and len(backlog) < config.CHANNEL_DIGEST_THRESHOLD:
+        database.release_outbox_jobs([post['job_id'] for post in backlog])
+        backlog = []
+
+    # If sending fails, the backlog's leases expire and its posts are retried
+    for message in shared.build_digest([post['body']['text'] for post in [job] + backlog]):
+        shared.send_channel_post(message)
+    for post in backlog:
+        database.complete_outbox_job(post['job_id'])
+    metrics.increment('outbox.completed', len(backlog))
     return
+
+
+# Undo the local side of a change that could not be written, and tell the user
+def fail_booking_job(job: dict, error) -> None:
+
+    if job['action'] == 'post': # the booking itself was written
+        logger.error('Channel Update Failure - %s - %s', job['event_id'], error)
+        return
+    logger.warning('Booking Job Rolled Back - %s - %s - %s', job['event_id'], job['action'], error)
+    rollback = job['rollback'] or {}
+    if rollback.get('event'):
+        mirror.apply(rollback['event'])
+    else:
+        mirror.remove(job['event_id'])
+    if rollback.get('reservation'):
+        database.reserve_booking(job['event_id'], *rollback['reservation'])
+    elif job['action'] != 'delete':
+        database.release_reservations([job['event_id']])
+
+    if job['chat_id']:
+        try:
+            shared.bot.send_message(chat_id = job['chat_id'], text = job['failure_notice'])
+        except Exception as send_error:
+            logger.warning('Failure Notice Not Sent - %s - %s', job['chat_id'], send_error)
+    return
+
+
+outbox = Outbox(
+    process = process_booking_job,
+    on_failure = fail_booking_job,
+    is_retryable = lambda error: isinstance(error, CircuitOpen) or is_retryable(error) or shared.is_retryable_channel_error(error), # keep jobs through an outage
+    workers = config.OUTBOX_WORKERS,
+    poll_interval = config.OUTBOX_POLL_INTERVAL,
+    max_attempts = config.OUTBOX_MAX_ATTEMPTS,
+    base_delay = config.OUTBOX_RETRY_BASE_DELAY,
+    max_delay = config.OUTBOX_RETRY_MAX_DELAY,
+    lease = config.OUTBOX_LEASE,
+    on_complete = lambda job: mirror.settle(job['event_id'], job['job_id']),
+    follow_up = channel_post_step
+)
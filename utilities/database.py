@@ -1,14 +1,111 @@
-import logging
+from contextlib import contextmanager
+from datetime import datetime
+import logging, time
+from threading import BoundedSemaphore, Event, Lock, Thread
 import psycopg2
+from psycopg2.errors import ExclusionViolation
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from utilities.cache import TTLCache
 import config
 
 logger = logging.getLogger(__name__)
 
+'''
+CONNECTION POOL
+'''
+pool = None
+pool_lock = Lock()
+pool_slots = BoundedSemaphore(config.DATABASE_POOL_MAX) # block callers instead of raising PoolError when exhausted
+last_used = {} # id(connection) -> monotonic time it was returned to the pool
+
+
+def get_pool() -> ThreadedConnectionPool:
+
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                pool = ThreadedConnectionPool(
+                    config.DATABASE_POOL_MIN,
+                    config.DATABASE_POOL_MAX,
+                    config.DATABASE_URL,
+                    sslmode = 'require'
+                )
+    return pool
+
+
+def is_alive(connection) -> bool:
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        connection.rollback() # end the implicit transaction opened by SELECT
+        return True
+    except psycopg2.Error:
+        return False
+
+
+# Check out a connection, replacing it if the server has dropped it while idle
+def checkout_connection():
+
+    connection = get_pool().getconn()
+    returned_at = last_used.pop(id(connection), None)
+    if connection.closed or (
+        returned_at is not None
+        and time.monotonic() - returned_at > config.DATABASE_POOL_IDLE_CHECK
+        and not is_alive(connection)
+    ):
+        logger.info('Replacing stale database connection')
+        get_pool().putconn(connection, close = True)
+        connection = get_pool().getconn()
+    return connection
+
+
+# Borrow a pooled connection for the duration of one transaction
+@contextmanager
+def pooled_connection():
+
+    pool_slots.acquire()
+    try:
+        connection = checkout_connection()
+    except Exception:
+        pool_slots.release()
+        raise
+
+    broken = False
+    try:
+        with connection: # commits on success, rolls back on exception
+            yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True # discard so the next checkout reconnects
+        raise
+    finally:
+        if not broken:
+            last_used[id(connection)] = time.monotonic()
+        get_pool().putconn(connection, close = broken)
+        pool_slots.release()
+
+
+def close_pool() -> None:
+
+    if pool is not None:
+        pool.closeall()
+    return
+
+
+'''
+USER PROFILE CACHE
+'''
+# Profiles keyed by user_id; kept in step by add_user and queue_username_update
+user_cache = TTLCache('user_cache', maxsize = config.USER_CACHE_SIZE, ttl = config.USER_CACHE_TTL)
+
+
 # Create table of users if it does not exist
 def create_if_not_exists() -> None:
     
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -20,12 +117,57 @@ def create_if_not_exists() -> None:
                         admin          BOOLEAN NOT NULL DEFAULT FALSE,
                         UNIQUE (rank_and_name, company)
                     );
+                    CREATE TABLE IF NOT EXISTS persistence (
+                        kind  TEXT NOT NULL,
+                        key   TEXT NOT NULL,
+                        data  BYTEA NOT NULL,
+                        PRIMARY KEY (kind, key)
+                    );
+                    CREATE TABLE IF NOT EXISTS settings (
+                        name   TEXT PRIMARY KEY,
+                        value  TEXT NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS outbox (
+                        job_id           BIGSERIAL PRIMARY KEY,
+                        event_id         TEXT NOT NULL,
+                        action           TEXT NOT NULL,
+                        body             JSONB,
+                        channel          JSONB,
+                        rollback         JSONB,
+                        chat_id          BIGINT,
+                        failure_notice   TEXT,
+                        attempts         INTEGER NOT NULL DEFAULT 0,
+                        next_attempt_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );
+                    CREATE INDEX IF NOT EXISTS outbox_event_id ON outbox (event_id, job_id);
                     """
                 )
     except Exception as error:
         logger.exception('Database Creation Failure - %s', error)
-    finally:
-        connection.close()
+
+    # Reservations need the btree_gist extension, so a failure here leaves the other tables in place
+    # and bookings go ahead without them, deconflicted by the mirror alone
+    global reservations_enabled
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    CREATE EXTENSION IF NOT EXISTS btree_gist;
+                    CREATE TABLE IF NOT EXISTS bookings (
+                        reservation_id  TEXT PRIMARY KEY,
+                        facility        TEXT NOT NULL,
+                        period          TSTZRANGE NOT NULL,
+                        confirmed       BOOLEAN NOT NULL DEFAULT FALSE,
+                        created_at      TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        EXCLUDE USING GIST (facility WITH =, period WITH &&)
+                    );
+                    """
+                )
+    except Exception as error:
+        logger.exception('Reservations Table Creation Failure - %s', error)
+    else:
+        reservations_enabled = True
     return
 
 
@@ -34,7 +176,7 @@ def add_user(user_id: int, user_data: dict) -> int:
     
     state = 0
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -47,39 +189,91 @@ def add_user(user_id: int, user_data: dict) -> int:
                 )
     except Exception as error:
         logger.exception('User Registration Failure - %s - %s', user_id, error)
+        user_cache.pop(user_id)
         state = -1
-    finally:
-        connection.close()
+    else:
+        user_cache.set(user_id, {
+            'rank_and_name': user_data['rank_and_name'],
+            'company': user_data['company'],
+            'username': user_data['username']
+        })
     return state
 
 
-# Update username record
-def update_username(user_id: int, new_username: str) -> None:
-    
+'''
+USERNAME WRITE-BEHIND
+Username changes are applied to the cache immediately and written to the
+database in batches by a background thread.
+'''
+pending_usernames = {} # user_id -> latest username awaiting flush
+pending_lock = Lock()
+flush_requested = Event()
+flush_thread = None
+
+
+def queue_username_update(user_id: int, new_username: str) -> None:
+
+    global flush_thread
+    user_cache.update(user_id, {'username': new_username})
+    with pending_lock:
+        pending_usernames[user_id] = new_username
+        if flush_thread is None:
+            flush_thread = Thread(target = username_flush_worker, name = 'username-flush', daemon = True)
+            flush_thread.start()
+        if len(pending_usernames) >= config.USERNAME_FLUSH_SIZE:
+            flush_requested.set()
+    return
+
+
+# Write all queued username changes in a single UPDATE
+def flush_username_updates() -> None:
+
+    global pending_usernames
+    with pending_lock:
+        batch, pending_usernames = pending_usernames, {}
+    if not batch:
+        return
+
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
-                cursor.execute(
+                execute_values(
+                    cursor,
                     """
                     UPDATE users
-                    SET username = %s
-                    WHERE user_id = %s
+                    SET username = data.username
+                    FROM (VALUES %s) AS data (user_id, username)
+                    WHERE users.user_id = data.user_id
                     """,
-                    (new_username, user_id)
+                    list(batch.items()),
+                    page_size = len(batch)
                 )
     except Exception as error:
-        logger.exception('Username Update Failure - %s - %s', user_id, error)
-    finally:
-        connection.close()
+        logger.exception('Username Batch Update Failure - %s users - %s', len(batch), error)
+        # Requeue for the next flush, unless a newer username has been queued since
+        with pending_lock:
+            for user_id, username in batch.items():
+                pending_usernames.setdefault(user_id, username)
     return
 
 
+def username_flush_worker() -> None:
+
+    while True:
+        flush_requested.wait(config.USERNAME_FLUSH_INTERVAL)
+        flush_requested.clear()
+        flush_username_updates()
+
+
 # Retrieve an existing user profile
 def retrieve_user(user_id: int):
     
+    if (cached_user := user_cache.get(user_id)):
+        return cached_user
+
     user_data = None
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -92,15 +286,15 @@ def retrieve_user(user_id: int):
                 user_data = cursor.fetchone()
     except Exception as error:
         logger.exception('User Retrieval Failure - %s - %s', user_id, error)
-    finally:
-        connection.close()
     
     if user_data:
-        return {
+        user_data = {
             'rank_and_name': user_data[0],
             'company': user_data[1],
             'username': user_data[2]
         }
+        user_cache.set(user_id, user_data)
+        return user_data
     return
     
 
@@ -109,7 +303,7 @@ def retrieve_user_by_rank_name_company(rank_and_name: str, company: str):
     
     user_data = None
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -123,8 +317,6 @@ def retrieve_user_by_rank_name_company(rank_and_name: str, company: str):
                 user_data = cursor.fetchone()
     except Exception as error:
         logger.exception('User Retrieval Failure - %s - %s', user_id, error)
-    finally:
-        connection.close()
     
     if user_data:
         return {
@@ -134,47 +326,452 @@ def retrieve_user_by_rank_name_company(rank_and_name: str, company: str):
     return
 
 
-# Retrieve set of admin user_ids
-def retrieve_admins() -> set:
-    
+# Set the admin flag on exactly the given users; returns the (added, removed) user_ids
+def sync_admins(admin_users: set) -> tuple:
+
     result = None
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
-                    SELECT user_id
-                    FROM users
-                    WHERE admin = TRUE
+                    UPDATE users
+                    SET admin = (user_id = ANY(%(admin_users)s::BIGINT[]))
+                    WHERE admin IS DISTINCT FROM (user_id = ANY(%(admin_users)s::BIGINT[]))
+                    RETURNING user_id, admin
+                    """,
+                    {'admin_users': list(admin_users)}
+                )
+                result = cursor.fetchall()
+    except Exception as error:
+        logger.exception('Admin Status Sync Failure - %s', error)
+
+    if result:
+        return {row[0] for row in result if row[1]}, {row[0] for row in result if not row[1]}
+    return set(), set()
+
+
+# Retrieve all stored settings as {name: value}
+def retrieve_settings() -> dict:
+
+    result = None
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT name, value
+                    FROM settings
                     """
                 )
                 result = cursor.fetchall()
     except Exception as error:
-        logger.exception('Admin Retrieval Failure - %s', error)
-    finally:
-        connection.close()
-    
+        logger.exception('Settings Retrieval Failure - %s', error)
+
     if result:
-        return {row[0] for row in result}
-    return set()
+        return dict(result)
+    return {}
 
 
-# Toggle user admin status
-def toggle_admin(user_id: int) -> None:
-    
+# Create or replace a stored setting
+def save_setting(name: str, value: str) -> None:
+
     try:
-        with psycopg2.connect(config.DATABASE_URL, sslmode = 'require') as connection:
+        with pooled_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
-                    UPDATE users
-                    SET admin = NOT admin
-                    WHERE user_id = %s
+                    INSERT INTO settings (name, value)
+                    VALUES (%s, %s)
+                    ON CONFLICT (name)
+                    DO UPDATE SET value = EXCLUDED.value
                     """,
-                    (user_id,)
+                    (name, value)
                 )
     except Exception as error:
-        logger.exception('Admin Status Change Failure - %s - %s', user_id, error)
-    finally:
-        connection.close()
-    return
\ No newline at end of file
+        logger.exception('Setting Update Failure - %s - %s', name, error)
+    return
+
+
+'''
+BOOKING RESERVATIONS
+Each user booking holds a row whose period no other row for the facility
+may overlap, so of two concurrent bookings for one slot only the first to
+reserve it succeeds. Rows are keyed by event id, which is generated before
+the event is inserted, and confirmed once the insert succeeds.
+'''
+reservations_enabled = False # set by create_if_not_exists once the bookings table exists
+
+
+# Reserve or move a facility's period; returns False if it overlaps another reservation
+def reserve_booking(reservation_id: str, facility: str, start: datetime, end: datetime) -> bool:
+
+    if not reservations_enabled:
+        return True
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO bookings (reservation_id, facility, period)
+                    VALUES (%s, %s, tstzrange(%s, %s, '[)'))
+                    ON CONFLICT (reservation_id)
+                    DO UPDATE SET (facility, period) = (EXCLUDED.facility, EXCLUDED.period)
+                    """,
+                    (reservation_id, facility, start, end)
+                )
+    except ExclusionViolation:
+        return False
+    except Exception as error:
+        # The mirror's conflict check still applies, so don't block bookings while the database is unavailable
+        logger.exception('Reservation Failure - %s - %s - %s', reservation_id, facility, error)
+    return True
+
+
+# Retrieve reservations overlapping a period as (reservation_id, confirmed, age in seconds, queued in outbox)
+def retrieve_overlapping_reservations(facility: str, start: datetime, end: datetime, exclude_id: str) -> list:
+
+    if not reservations_enabled:
+        return []
+    result = None
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT
+                        reservation_id,
+                        confirmed,
+                        EXTRACT(EPOCH FROM now() - created_at),
+                        EXISTS (SELECT 1 FROM outbox WHERE outbox.event_id = bookings.reservation_id)
+                    FROM bookings
+                    WHERE facility = %s
+                    AND period && tstzrange(%s, %s, '[)')
+                    AND reservation_id <> %s
+                    """,
+                    (facility, start, end, exclude_id)
+                )
+                result = cursor.fetchall()
+    except Exception as error:
+        logger.exception('Reservation Retrieval Failure - %s - %s', facility, error)
+    return result or []
+
+
+# Mark a reservation as belonging to an event that exists in the calendar
+def confirm_reservation(event_id: str) -> None:
+
+    if not reservations_enabled:
+        return
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE bookings
+                    SET confirmed = TRUE
+                    WHERE reservation_id = %s
+                    """,
+                    (event_id,)
+                )
+    except Exception as error:
+        logger.exception('Reservation Confirmation Failure - %s - %s', event_id, error)
+    return
+
+
+# Retrieve a reservation's (facility, lower, upper), or None
+def retrieve_reservation(reservation_id: str):
+
+    if not reservations_enabled:
+        return None
+    result = None
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT facility, lower(period), upper(period)
+                    FROM bookings
+                    WHERE reservation_id = %s
+                    """,
+                    (reservation_id,)
+                )
+                result = cursor.fetchone()
+    except Exception as error:
+        logger.exception('Reservation Retrieval Failure - %s - %s', reservation_id, error)
+    return result
+
+
+def release_reservations(reservation_ids: list) -> None:
+
+    if not reservations_enabled:
+        return
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    DELETE FROM bookings
+                    WHERE reservation_id = ANY(%s)
+                    """,
+                    (list(reservation_ids),)
+                )
+    except Exception as error:
+        logger.exception('Reservation Release Failure - %s - %s', reservation_ids, error)
+    return
+
+
+# Delete reservations whose period has passed, which nothing can overlap any more
+def prune_reservations() -> None:
+
+    if not reservations_enabled:
+        return
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    DELETE FROM bookings
+                    WHERE upper(period) < now()
+                    """
+                )
+                pruned = cursor.rowcount
+    except Exception as error:
+        logger.exception('Reservation Pruning Failure - %s', error)
+        return
+    if pruned:
+        logger.info('Past Reservations Pruned - %s', pruned)
+    return
+
+
+'''
+BOOKING OUTBOX
+Calendar writes and their channel posts, recorded in the same transaction
+as the reservation change and carried out by background workers. A job is
+deleted once done. Only the oldest job for an event can be claimed, so each
+event's jobs run in order.
+'''
+# Record a job, reserving or releasing its event's slot in the same transaction;
+# returns the job_id, or None if the reservation overlaps another
+def enqueue_booking_job(job: dict, reservation: tuple = None, release: bool = False):
+
+    try:
+        with pooled_connection() as connection:
+            with connection.cursor() as cursor:
+                if reservation and reservations_enabled:
+                    cursor.execute(
+                        """
+                        INSERT INTO bookings (reservation_id, facility, period)
+                        VALUES (%s, %s, tstzrange(%s, %s, '[)'))
+                        ON CONFLICT (reservation_id)
+                        DO UPDATE SET (facility, period) = (EXCLUDED.facility, EXCLUDED.period)
+                        """,
+                        (job['event_id'], *reservation)
+                    )
+                if release and reservations_enabled:
+                    cursor.execute(
+                        """
+                        DELETE FROM bookings
+                        WHERE reservation_id = %s
+                        """,
+                        (job['event_id'],)
+                    )
+                cursor.execute(
+                    """
+                    INSERT INTO outbox (event_id, action, body, channel, rollback, chat_id, failure_notice)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    RETURNING job_id
+                    """,
+                    (
+                        job['event_id'],
+                        job['action'],
+                        Json(job['body']),
+                        Json(job['channel']),
+                        Json(job['rollback']),
+                        job['chat_id'],
+                        job['failure_notice']
+                    )
+                )
+                return cursor.fetchone()[0]
+    except ExclusionViolation:
+        return None
+
+
+# Claim up to `limit` due jobs, optionally of one action, hiding them from other workers for `lease` seconds
+def claim_outbox_jobs(lease: int, limit: int = 1, action: str = None) -> list:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE outbox
+                SET attempts = attempts + 1, next_attempt_at = now() + make_interval(secs => %s)
+                WHERE job_id IN (
+                    SELECT job_id
+                    FROM outbox AS job
+                    WHERE next_attempt_at <= now()
+                    AND (%s::text IS NULL OR action = %s)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM outbox AS earlier
+                        WHERE earlier.event_id = job.event_id
+                        AND earlier.job_id < job.job_id
+                    )
+                    ORDER BY job_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING job_id, event_id, action, body, channel, rollback, chat_id, failure_notice, attempts
+                """,
+                (lease, action, action, limit)
+            )
+            columns = [column.name for column in cursor.description]
+            return sorted((dict(zip(columns, row)) for row in cursor.fetchall()), key = lambda job: job['job_id'])
+
+
+# Retrieve every unfinished job, oldest first
+def retrieve_outbox_jobs() -> list:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT job_id, event_id, action, body, rollback
+                FROM outbox
+                ORDER BY job_id
+                """
+            )
+            columns = [column.name for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def complete_outbox_job(job_id: int) -> None:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM outbox
+                WHERE job_id = %s
+                """,
+                (job_id,)
+            )
+    return
+
+
+def retry_outbox_job(job_id: int, delay: float) -> None:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE outbox
+                SET next_attempt_at = now() + make_interval(secs => %s)
+                WHERE job_id = %s
+                """,
+                (delay, job_id)
+            )
+    return
+
+
+# Turn a job into its next step, e.g. a booking's channel post, due now with fresh attempts
+def advance_outbox_job(job_id: int, action: str, body: dict) -> None:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE outbox
+                SET action = %s, body = %s, attempts = 0, next_attempt_at = now()
+                WHERE job_id = %s
+                """,
+                (action, Json(body), job_id)
+            )
+    return
+
+
+# Hand claimed jobs back unattempted
+def release_outbox_jobs(job_ids: list) -> None:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE outbox
+                SET attempts = attempts - 1, next_attempt_at = now()
+                WHERE job_id = ANY(%s)
+                """,
+                (list(job_ids),)
+            )
+    return
+
+
+'''
+CONVERSATION PERSISTENCE
+Pickled chat_data, user_data and conversation states, one row per key.
+'''
+# Retrieve one persisted value, or None if nothing is stored
+def retrieve_persisted(kind: str, key: str):
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT data
+                FROM persistence
+                WHERE kind = %s
+                AND key = %s
+                """,
+                (kind, key)
+            )
+            row = cursor.fetchone()
+    return bytes(row[0]) if row else None
+
+
+# Retrieve every persisted value of one kind as {key: data}
+def retrieve_persisted_kind(kind: str) -> dict:
+
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT key, data
+                FROM persistence
+                WHERE kind = %s
+                """,
+                (kind,)
+            )
+            rows = cursor.fetchall()
+    return {key: bytes(data) for key, data in rows}
+
+
+# Write a batch of {(kind, key): data} in one transaction; None deletes the row
+def save_persisted(batch: dict) -> None:
+
+    upserts = [(kind, key, data) for (kind, key), data in batch.items() if data is not None]
+    deletes = [(kind, key) for (kind, key), data in batch.items() if data is None]
+    with pooled_connection() as connection:
+        with connection.cursor() as cursor:
+            if upserts:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO persistence (kind, key, data)
+                    VALUES %s
+                    ON CONFLICT (kind, key)
+                    DO UPDATE SET data = EXCLUDED.data
+                    """,
+                    upserts,
+                    page_size = len(upserts)
+                )
+            if deletes:
+                execute_values(
+                    cursor,
+                    """
+                    DELETE FROM persistence
+                    USING (VALUES %s) AS data (kind, key)
+                    WHERE persistence.kind = data.kind
+                    AND persistence.key = data.key
+                    """,
+                    deletes,
+                    page_size = len(deletes)
+                )
+    return
@@ -0,0 +1,67 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from threading import Lock
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+'''
+CONCURRENT DISPATCHER
+Updates from different chats are handled concurrently, at most max_in_flight
+at a time. Updates from the same chat are handled one at a time and in
+order, so a slow Calendar call only holds up its own chat and conversation
+states never race.
+'''
+class ConcurrentDispatcher(Dispatcher):
+
+    def __init__(self, *args, max_in_flight: int = 8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = max_in_flight
+        self._update_pool = ThreadPoolExecutor(max_workers = max_in_flight, thread_name_prefix = 'update')
+        self._chat_queues = {} # chat id -> deque of updates, head is being processed
+        self._chat_queues_lock = Lock()
+
+    def process_update(self, update: object) -> None:
+
+        # Errors and custom updates keep the default behaviour
+        if not isinstance(update, Update):
+            return super().process_update(update)
+
+        if update.effective_chat:
+            key = update.effective_chat.id
+        elif update.effective_user:
+            key = update.effective_user.id
+        else:
+            key = None
+
+        with self._chat_queues_lock:
+            if key in self._chat_queues:
+                self._chat_queues[key].append(update) # picked up when the chat's current update finishes
+                return
+            self._chat_queues[key] = deque([update])
+        self._update_pool.submit(self._process_chat, key)
+        return
+
+    def _process_chat(self, key) -> None:
+
+        while True:
+            with self._chat_queues_lock:
+                update = self._chat_queues[key][0]
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception('Update Processing Failure - %s', key)
+            with self._chat_queues_lock:
+                chat_queue = self._chat_queues[key]
+                chat_queue.popleft()
+                if not chat_queue:
+                    del self._chat_queues[key]
+                    return
+
+    def stop(self) -> None:
+
+        super().stop()
+        self._update_pool.shutdown(wait = True) # finish updates already accepted
+        return
@@ -0,0 +1,69 @@
+from bisect import bisect_left, bisect_right
+
+'''
+TIME CONVERSION
+'''
+def to_minutes(time_string: str) -> int:
+    # 'HH:MM' -> minutes since midnight
+    return int(time_string[:2]) * 60 + int(time_string[3:5])
+
+
+def from_minutes(minutes: int) -> str:
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+'''
+INTERVAL INDEX
+Half-open [start, end) intervals in minutes, sorted by start time. Bookings
+may overlap (admin bookings skip conflict checks), so an overlap query looks
+back from the query start by the length of the longest interval.
+'''
+class IntervalIndex:
+
+    def __init__(self):
+        self._starts = [] # sorted start times
+        self._entries = [] # (start, end, key), parallel to _starts
+        self._spans = {} # key -> (start, end)
+        self._longest = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        # Keys in order of start time
+        return (key for _, _, key in self._entries)
+
+    def add(self, start: int, end: int, key) -> None:
+
+        if key in self._spans:
+            self.remove(key)
+        idx = bisect_right(self._starts, start)
+        self._starts.insert(idx, start)
+        self._entries.insert(idx, (start, end, key))
+        self._spans[key] = (start, end)
+        self._longest = max(self._longest, end - start)
+        return
+
+    def remove(self, key) -> None:
+
+        if (span := self._spans.pop(key, None)) is None:
+            return
+        idx = bisect_left(self._starts, span[0])
+        while self._entries[idx][2] != key:
+            idx += 1
+        del self._starts[idx]
+        del self._entries[idx]
+        if span[1] - span[0] == self._longest:
+            self._longest = max((end - start for start, end, _ in self._entries), default = 0)
+        return
+
+    def overlapping(self, start: int, end: int) -> list:
+
+        # Only intervals starting after (start - longest) and before end can overlap
+        lo = bisect_right(self._starts, start - self._longest)
+        hi = bisect_left(self._starts, end)
+        return [key for _, entry_end, key in self._entries[lo:hi] if entry_end > start]
+
+    def spans(self) -> list:
+        # (start, end) pairs in order of start time
+        return [(start, end) for start, end, _ in self._entries]
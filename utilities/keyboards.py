@@ -1,5 +1,6 @@
 from itertools import zip_longest
-from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from utilities import shared
 import config
 
 '''
@@ -61,14 +62,17 @@ continue_with_booking = InlineKeyboardMarkup([[InlineKeyboardButton('Continue wi
 
 move_previous = InlineKeyboardMarkup([[InlineKeyboardButton('Move Previous Booking', callback_data = 'patch')]])
 
+view_calendar = InlineKeyboardMarkup([[InlineKeyboardButton('Open Bookings Calendar', url=config.CALENDAR_URL)]])
+
+# The event link is None while the booking is still being written to the calendar
 def show_in_calendar(event_url: str) -> InlineKeyboardMarkup:
     
+    if not event_url:
+        return view_calendar
     return InlineKeyboardMarkup([
         [InlineKeyboardButton('Show in Google Calendar', url=event_url)]
     ])
 
-view_calendar = InlineKeyboardMarkup([[InlineKeyboardButton('Open Bookings Calendar', url=config.CALENDAR_URL)]])
-
 '''
 GENERATED OPTIONS SELECTORS
 '''
@@ -91,10 +95,17 @@ def facilities_minus(facility: str) -> InlineKeyboardMarkup:
     return generate_menu(facilities)
 
 
-def contact_poc(booking_conflicts: list, effective_username: str) -> InlineKeyboardMarkup:
+def contact_poc(booking_conflicts: list, effective_username: str, suggested_slots: list = ()) -> InlineKeyboardMarkup:
     
     buttons = set()
     
+    # Look up every POC without a username at once
+    shared.prefetch_private_forwards(
+        conflict['extendedProperties']['shared']['user_id'] for conflict in booking_conflicts
+        if conflict['extendedProperties']['shared']['username'] == 'NULL'
+        and conflict['extendedProperties']['shared']['user_id'] != 'NULL'
+    )
+    
     for conflict in booking_conflicts:
         if conflict['extendedProperties']['shared']['username'] != effective_username:
             if conflict['extendedProperties']['shared']['user_id'] != 'NULL': # admin bookings for unregistered users don't carry user ids
@@ -102,12 +113,22 @@ def contact_poc(booking_conflicts: list, effective_username: str) -> InlineKeybo
                 if conflict['extendedProperties']['shared']['username'] != 'NULL': # some telegram users don't have usernames
                     buttons.add(InlineKeyboardButton(button_text, url = f'https://t.me/{conflict["extendedProperties"]["shared"]["username"]}'))
                 else:
-                    if not Bot(config.BOT_TOKEN).get_chat(conflict['extendedProperties']['shared']['user_id']).has_private_forwards:
+                    if not shared.has_private_forwards(conflict['extendedProperties']['shared']['user_id']):
                         buttons.add(InlineKeyboardButton(button_text, url = f'tg://user?id={conflict["extendedProperties"]["shared"]["user_id"]}'))
         
     buttons = list(buttons)
     buttons = [[button] for button in buttons]
-    return InlineKeyboardMarkup(buttons)
+    return InlineKeyboardMarkup(time_slots(suggested_slots) + buttons)
+
+
+def time_slots(slots: list, row_size: int = 3) -> list:
+    
+    # Callback data mirrors the HHmm-HHmm format users type
+    buttons = [
+        InlineKeyboardButton(f'{start}-{end}', callback_data = f"{start.replace(':', '')}-{end.replace(':', '')}")
+        for start, end in slots
+    ]
+    return [buttons[idx:idx + row_size] for idx in range(0, len(buttons), row_size)]
 
 
 def user_bookings(bookings):
@@ -0,0 +1,80 @@
+import logging
+from threading import Lock, Thread
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+IN-PROCESS METRICS
+Counters, gauges and timings, logged every METRICS_LOG_INTERVAL seconds.
+'''
+lock = Lock()
+counters = {} # name -> count
+gauges = {} # name -> latest value
+timings = {} # name -> [count, total seconds, max seconds]
+reporter_thread = None
+
+
+def increment(name: str, value: int = 1) -> None:
+
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+    return
+
+
+def set_gauge(name: str, value: float) -> None:
+
+    with lock:
+        gauges[name] = value
+    return
+
+
+def observe(name: str, seconds: float) -> None:
+
+    with lock:
+        timing = timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+    return
+
+
+def snapshot() -> dict:
+
+    with lock:
+        return {
+            'counters': dict(counters),
+            'gauges': dict(gauges),
+            'timings': {
+                name: {'count': count, 'mean': total / count, 'max': longest}
+                for name, (count, total, longest) in timings.items()
+            }
+        }
+
+
+def log_snapshot() -> None:
+
+    current = snapshot()
+    for name, count in sorted(current['counters'].items()):
+        logger.info('%s = %s', name, count)
+    for name, value in sorted(current['gauges'].items()):
+        logger.info('%s = %.3f', name, value)
+    for name, timing in sorted(current['timings'].items()):
+        logger.info('%s: n=%s mean=%.3fs max=%.3fs', name, timing['count'], timing['mean'], timing['max'])
+    return
+
+
+def start_reporter(interval: int) -> None:
+
+    global reporter_thread
+    if reporter_thread is None and interval > 0:
+        reporter_thread = Thread(target = report_forever, args = (interval,), name = 'metrics-reporter', daemon = True)
+        reporter_thread.start()
+    return
+
+
+def report_forever(interval: int) -> None:
+
+    while True:
+        time.sleep(interval)
+        log_snapshot()
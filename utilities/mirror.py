@@ -0,0 +1,281 @@
+from bisect import bisect_left, insort
+from datetime import datetime
+import logging, time
+from threading import Event, Lock, RLock, Thread
+from utilities.availability import occupancy_bitmap
+from utilities.breaker import CircuitOpen
+from utilities.intervals import IntervalIndex, to_minutes
+from utilities.throttle import ThrottleTimeout
+import config
+
+logger = logging.getLogger(__name__)
+
+'''
+LOCAL MIRROR OF THE BOOKINGS CALENDAR
+Kept current with events.list sync tokens: the first sync lists every event,
+later syncs only fetch what changed since the previous sync token. Google
+expires sync tokens with 410 Gone, in which case the mirror is rebuilt.
+Changes still waiting in the outbox override the calendar until their job
+completes, and are reloaded from the outbox whenever the mirror is rebuilt.
+'''
+class BookingsMirror:
+
+    def __init__(self, fetch_page, interval: int, fetch_pending = None):
+        self.fetch_page = fetch_page # callable(sync_token, page_token) -> events.list response
+        self.fetch_pending = fetch_pending # callable() -> {event id: (job_id, event or None to delete)}
+        self.interval = interval
+        self.sync_token = None
+        self.last_synced = None # monotonic time of last successful sync
+        self._events = {} # event id -> event
+        self._by_facility_date = {} # (facility, date) -> IntervalIndex of event ids
+        self._timeline = [] # sorted (date, start_time, event id) of every booking
+        self._local_writes = {} # event id -> monotonic time of last local write
+        self._pending = {} # event id -> (job_id, event or None) of its latest unfinished outbox job
+        self._settled = {} # event id -> (latest completed job_id, monotonic time it completed)
+        self._lock = RLock()
+        self._sync_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    '''
+    SYNCING
+    '''
+    def start(self) -> None:
+
+        if self._thread is None:
+            self._thread = Thread(target = self._sync_loop, name = 'calendar-sync', daemon = True)
+            self._thread.start()
+        return
+
+    def stop(self) -> None:
+        self._stopped.set()
+        return
+
+    def _sync_loop(self) -> None:
+
+        while not self._stopped.is_set():
+            try:
+                self.sync()
+            except (CircuitOpen, ThrottleTimeout) as error:
+                logger.warning('Calendar Sync Skipped - %s', error)
+            except Exception as error:
+                logger.exception('Calendar Sync Failure - %s', error)
+            self._stopped.wait(self.interval)
+
+    def ensure_synced(self) -> None:
+
+        if self.last_synced is None:
+            self.sync()
+        return
+
+    def sync(self) -> None:
+
+        from googleapiclient.errors import HttpError # deferred with the rest of the client library
+        with self._sync_lock:
+            started = time.monotonic()
+            previous_sync = self.last_synced or 0
+            full_sync = self.sync_token is None
+            try:
+                changes, sync_token = self._fetch_changes(self.sync_token)
+            except HttpError as error:
+                if error.resp.status != 410:
+                    raise
+                logger.info('Calendar sync token expired, running full sync')
+                full_sync = True
+                changes, sync_token = self._fetch_changes(None)
+
+            pending = self._load_pending() if full_sync else None
+
+            with self._lock:
+                if full_sync:
+                    local_events = {
+                        event_id: self._events[event_id] for event_id, written in self._local_writes.items()
+                        if written > started and event_id in self._events
+                    }
+                    self._events = {}
+                    self._by_facility_date = {}
+                    self._timeline = []
+                    for event in local_events.values():
+                        self._add(event)
+                    if pending is not None:
+                        # Keep changes queued since the outbox was read, and drop jobs that have completed since
+                        for event_id, change in self._pending.items():
+                            if change[0] > pending.get(event_id, (0, None))[0]:
+                                pending[event_id] = change
+                        self._pending = {
+                            event_id: change for event_id, change in pending.items() if not self._is_settled(event_id, change[0])
+                        }
+                    for event_id, (_, event) in self._pending.items():
+                        self._remove(event_id)
+                        if event is not None:
+                            self._add(event)
+
+                for event in changes:
+                    # Don't let a page fetched before a local write, or a change still in the outbox, undo it
+                    if self._local_writes.get(event['id'], 0) > started or event['id'] in self._pending:
+                        continue
+                    self._remove(event['id'])
+                    if event.get('status') != 'cancelled':
+                        self._add(event)
+
+                self._local_writes = {
+                    event_id: written for event_id, written in self._local_writes.items() if written > started
+                }
+                # Completions are remembered for at least a sync interval, much longer than a late write can take
+                self._settled = {
+                    event_id: settled for event_id, settled in self._settled.items() if settled[1] > previous_sync
+                }
+                self._prune()
+                self.sync_token = sync_token
+                self.last_synced = time.monotonic()
+        return
+
+    # Unfinished outbox changes, or None to keep the ones already held
+    def _load_pending(self):
+
+        if self.fetch_pending is None:
+            return None
+        try:
+            return self.fetch_pending()
+        except Exception as error:
+            logger.exception('Pending Bookings Retrieval Failure - %s', error)
+            return None
+
+    def _fetch_changes(self, sync_token: str):
+
+        changes = []
+        page_token = None
+        while True:
+            page = self.fetch_page(sync_token, page_token)
+            changes += page.get('items', [])
+            if not (page_token := page.get('nextPageToken')):
+                return changes, page.get('nextSyncToken')
+
+    '''
+    LOCAL WRITES
+    Applied straight away so reads don't wait for the next sync. Writes made
+    with a job_id are held until settle() is called for that job, and are
+    dropped if the job has already completed: its result is applied already.
+    '''
+    def apply(self, event: dict, job_id: int = None) -> None:
+
+        with self._lock:
+            if job_id is not None and self._is_settled(event['id'], job_id):
+                return
+            self._local_writes[event['id']] = time.monotonic()
+            if job_id is not None:
+                self._pending[event['id']] = (job_id, event)
+            self._remove(event['id'])
+            self._add(event)
+        return
+
+    def remove(self, event_id: str, job_id: int = None) -> None:
+
+        with self._lock:
+            if job_id is not None and self._is_settled(event_id, job_id):
+                return
+            self._local_writes[event_id] = time.monotonic()
+            if job_id is not None:
+                self._pending[event_id] = (job_id, None)
+            self._remove(event_id)
+        return
+
+    # Stop holding an event's change once its outbox job, or a later one, has completed
+    def settle(self, event_id: str, job_id: int) -> None:
+
+        with self._lock:
+            if not self._is_settled(event_id, job_id):
+                self._settled[event_id] = (job_id, time.monotonic())
+            if (change := self._pending.get(event_id)) and change[0] <= job_id:
+                del self._pending[event_id]
+        return
+
+    def _is_settled(self, event_id: str, job_id: int) -> bool:
+        return job_id <= self._settled.get(event_id, (0, None))[0]
+
+    def _add(self, event: dict) -> None:
+
+        # Ignore events that weren't created by the bot
+        if not (details := event.get('extendedProperties', {}).get('shared', {})).get('facility'):
+            return
+        self._events[event['id']] = event
+        self._by_facility_date.setdefault((details['facility'], details['date']), IntervalIndex()).add(
+            to_minutes(details['start_time']),
+            to_minutes(details['end_time']),
+            event['id']
+        )
+        insort(self._timeline, (details['date'], details['start_time'], event['id']))
+        return
+
+    def _remove(self, event_id: str) -> None:
+
+        if (event := self._events.pop(event_id, None)):
+            details = event['extendedProperties']['shared']
+            key = (details['facility'], details['date'])
+            self._by_facility_date[key].remove(event_id)
+            if not self._by_facility_date[key]:
+                del self._by_facility_date[key]
+            del self._timeline[bisect_left(self._timeline, (details['date'], details['start_time'], event_id))]
+        return
+
+    # Drop bookings from before today
+    def _prune(self) -> None:
+
+        current_date = datetime.now(config.TIMEZONE).strftime('%Y-%m-%d')
+        for event_id in [
+            event_id for event_id, event in self._events.items()
+            if event['extendedProperties']['shared']['date'] < current_date
+        ]:
+            self._remove(event_id)
+        return
+
+    '''
+    QUERIES
+    Results are ordered by start time, like events.list with orderBy = 'startTime'.
+    '''
+    def get(self, event_id: str):
+
+        self.ensure_synced()
+        with self._lock:
+            return self._events.get(event_id)
+
+    def bookings_for_facility_by_date(self, facility: str, date: str) -> list:
+
+        self.ensure_synced()
+        with self._lock:
+            return [self._events[event_id] for event_id in self._by_facility_date.get((facility, date), ())]
+
+    # Bookings overlapping [start, end), in minutes since midnight, for each facility
+    def overlapping_bookings(self, facilities: list, date: str, start: int, end: int) -> dict:
+
+        self.ensure_synced()
+        conflicts = {}
+        with self._lock:
+            for facility in facilities:
+                index = self._by_facility_date.get((facility, date))
+                conflicts[facility] = [self._events[event_id] for event_id in index.overlapping(start, end)] if index else []
+        return conflicts
+
+    # Occupancy bitmap of each facility on a date
+    def occupancy(self, facilities: list, date: str) -> dict:
+
+        self.ensure_synced()
+        with self._lock:
+            return {
+                facility: occupancy_bitmap(index.spans()) if (index := self._by_facility_date.get((facility, date))) else 0
+                for facility in facilities
+            }
+
+    # Bookings whose shared property `field` equals `value`, dated from_date up to and including to_date
+    def iter_bookings(self, field: str, value: str, from_date: str, to_date: str):
+
+        self.ensure_synced()
+        with self._lock:
+            # Snapshot the range so the lock isn't held while the caller consumes results
+            lo = bisect_left(self._timeline, (from_date,))
+            hi = bisect_left(self._timeline, (to_date + '\uffff',))
+            events = [self._events[event_id] for _, _, event_id in self._timeline[lo:hi]]
+
+        for event in events:
+            if event['extendedProperties']['shared'].get(field) == value:
+                yield event
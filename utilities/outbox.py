@@ -0,0 +1,123 @@
+import logging, random, time
+from threading import Event, Lock, Thread
+from utilities import database, metrics
+
+logger = logging.getLogger(__name__)
+
+'''
+OUTBOX WORKERS
+Carry out jobs recorded in the outbox table. A job whose `process` call
+raises a retryable error is retried with exponential backoff; any other
+error, or running out of attempts, hands it to `on_failure`. A job may have
+a follow-up step, which replaces it in the same row once `process`
+succeeds. Callers can wait briefly for the result of a job they just
+recorded.
+'''
+class Outbox:
+
+    def __init__(self, process, on_failure, is_retryable, workers: int, poll_interval: float, max_attempts: int, base_delay: float, max_delay: float, lease: int, on_complete = None, follow_up = None):
+        self.process = process # callable(job) -> result
+        self.on_failure = on_failure # callable(job, error)
+        self.on_complete = on_complete # callable(job), once the job is deleted or advanced to its follow-up
+        self.follow_up = follow_up # callable(job, result) -> (action, body) of the next step, or None
+        self.is_retryable = is_retryable # callable(error) -> bool
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay # seconds before the first retry, doubled for each later one
+        self.max_delay = max_delay
+        self.lease = lease # seconds a claimed job stays hidden from other workers, in case this one dies
+        self._wake = Event()
+        self._stopped = Event()
+        self._waiters = {} # job_id -> [Event, result]
+        self._waiters_lock = Lock()
+        self._threads = []
+
+    def start(self) -> None:
+
+        if not self._threads:
+            for number in range(self.workers):
+                thread = Thread(target = self._work, name = f'outbox-{number}', daemon = True)
+                thread.start()
+                self._threads.append(thread)
+        return
+
+    # Finish jobs in progress before shutdown
+    def stop(self, timeout: float = 10) -> None:
+
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        return
+
+    # Wake a worker for a job just recorded and wait up to `timeout` seconds for its result
+    def wait(self, job_id: int, timeout: float):
+
+        waiter = [Event(), None]
+        with self._waiters_lock:
+            self._waiters[job_id] = waiter
+        self._wake.set()
+        done = waiter[0].wait(timeout)
+        with self._waiters_lock:
+            self._waiters.pop(job_id, None)
+        return waiter[1] if done else None
+
+    def _resolve(self, job_id: int, result) -> None:
+
+        with self._waiters_lock:
+            if (waiter := self._waiters.get(job_id)):
+                waiter[1] = result
+                waiter[0].set()
+        return
+
+    def _work(self) -> None:
+
+        retry_at = None # monotonic time of the earliest retry this worker scheduled
+        while not self._stopped.is_set():
+            try:
+                job = next(iter(database.claim_outbox_jobs(self.lease)), None)
+            except Exception as error:
+                logger.warning('Outbox Claim Failure - %s', error)
+                job = None
+            if job is None:
+                timeout = self.poll_interval if retry_at is None else min(self.poll_interval, max(0, retry_at - time.monotonic()))
+                retry_at = None
+                self._wake.wait(timeout)
+                self._wake.clear()
+                continue
+            try:
+                if (delay := self._run(job)) is not None:
+                    retry_at = min(retry_at or float('inf'), time.monotonic() + delay)
+            except Exception as error:
+                logger.exception('Outbox Job Failure - %s - %s', job['job_id'], error) # the lease expires and the job is retried
+
+    # Returns the delay before the job's next attempt if it is to be retried
+    def _run(self, job: dict):
+
+        step = None
+        try:
+            result = self.process(job)
+            step = self.follow_up and self.follow_up(job, result)
+        except Exception as error:
+            if self.is_retryable(error) and job['attempts'] < self.max_attempts:
+                delay = random.uniform(0, min(self.base_delay * 2 ** job['attempts'], self.max_delay)) # full jitter
+                delay = max(delay, getattr(error, 'retry_after', 0)) # e.g. Telegram's flood control
+                logger.warning('Outbox Job %s Attempt %s Failed - retrying in %.1fs - %s', job['job_id'], job['attempts'], delay, error)
+                metrics.increment('outbox.retries')
+                database.retry_outbox_job(job['job_id'], delay)
+                return delay
+            logger.error('Outbox Job %s Abandoned - %s - %s', job['job_id'], job['action'], error)
+            metrics.increment('outbox.failures')
+            self.on_failure(job, error)
+            result = None
+        if step:
+            database.advance_outbox_job(job['job_id'], *step)
+            self._wake.set()
+        else:
+            database.complete_outbox_job(job['job_id'])
+        metrics.increment('outbox.completed')
+        if self.on_complete:
+            self.on_complete(job)
+        self._resolve(job['job_id'], result)
+        return None
@@ -0,0 +1,149 @@
+from collections import defaultdict
+import logging, pickle, time
+from threading import Lock, Thread
+import ujson
+from telegram.ext import BasePersistence
+from utilities import database
+
+logger = logging.getLogger(__name__)
+
+'''
+POSTGRES PERSISTENCE
+Keeps chat_data, user_data and conversation states across restarts.
+chat_data and user_data are loaded per chat or user on first access;
+conversation states, of which only in-flight ones are stored, are loaded
+per handler at startup. Changed values are written in batches every
+PERSISTENCE_FLUSH_INTERVAL seconds and at shutdown. If a load fails, the
+update gets empty data that is neither kept nor written back.
+'''
+class LazyLoader:
+
+    def __init__(self, persistence, kind: str):
+        self.persistence = persistence
+        self.kind = kind
+
+    def __call__(self, key) -> dict:
+        return self.persistence.load(self.kind, key)
+
+
+class PersistedDataUnavailable(Exception):
+    pass
+
+
+# defaultdict that fills missing keys from the database instead of with empty values
+class LazyDict(defaultdict):
+
+    def __missing__(self, key):
+        try:
+            value = self[key] = self.default_factory(key)
+        except PersistedDataUnavailable:
+            return {} # not kept, so the next access retries the load
+        return value
+
+
+class PostgresPersistence(BasePersistence):
+
+    def __init__(self, flush_interval: int):
+        super().__init__(store_user_data = True, store_chat_data = True, store_bot_data = False, store_callback_data = False)
+        self.flush_interval = flush_interval
+        self._written = {} # (kind, key) -> pickle last read from or written to the database
+        self._dirty = {} # (kind, key) -> pickle awaiting flush, None to delete
+        self._unavailable = set() # (kind, key) whose last load failed, never written until it succeeds
+        self._lock = Lock()
+        self._flush_thread = None
+
+    def load(self, kind: str, key) -> dict:
+
+        try:
+            data = database.retrieve_persisted(kind, str(key))
+        except Exception as error:
+            logger.exception('Persisted Data Retrieval Failure - %s - %s - %s', kind, key, error)
+            with self._lock:
+                self._unavailable.add((kind, str(key)))
+            raise PersistedDataUnavailable(f'{kind} {key}') from error
+        if data is None:
+            data = pickle.dumps({})
+        with self._lock:
+            self._unavailable.discard((kind, str(key)))
+            self._written[(kind, str(key))] = data
+        return pickle.loads(data)
+
+    def get_user_data(self) -> defaultdict:
+        return LazyDict(LazyLoader(self, 'user_data'))
+
+    def get_chat_data(self) -> defaultdict:
+        return LazyDict(LazyLoader(self, 'chat_data'))
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+
+        try:
+            rows = database.retrieve_persisted_kind(f'conversation:{name}')
+        except Exception as error:
+            logger.exception('Persisted Conversations Retrieval Failure - %s - %s', name, error)
+            return {}
+        with self._lock:
+            for key, data in rows.items():
+                self._written[(f'conversation:{name}', key)] = data
+        return {tuple(ujson.loads(key)): pickle.loads(data) for key, data in rows.items()}
+
+    def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._mark(f'conversation:{name}', ujson.dumps(list(key)), None if new_state is None else pickle.dumps(new_state))
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        self._mark('user_data', str(user_id), pickle.dumps(data))
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._mark('chat_data', str(chat_id), pickle.dumps(data))
+
+    def update_bot_data(self, data) -> None:
+        return
+
+    # Queue a value for the next flush if it differs from what the database holds
+    def _mark(self, kind: str, key: str, data) -> None:
+
+        with self._lock:
+            if (kind, key) in self._unavailable: # don't overwrite what couldn't be read
+                return
+            if self._written.get((kind, key)) == data:
+                self._dirty.pop((kind, key), None)
+                return
+            self._dirty[(kind, key)] = data
+            if self._flush_thread is None:
+                self._flush_thread = Thread(target = self._flush_worker, name = 'persistence-flush', daemon = True)
+                self._flush_thread.start()
+        return
+
+    # Write all changed values in one transaction
+    def flush(self) -> None:
+
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+
+        try:
+            database.save_persisted(batch)
+        except Exception as error:
+            logger.exception('Persisted Data Update Failure - %s keys - %s', len(batch), error)
+            # Requeue for the next flush, unless a newer value has been queued since
+            with self._lock:
+                for item, data in batch.items():
+                    self._dirty.setdefault(item, data)
+            return
+
+        with self._lock:
+            for item, data in batch.items():
+                if data is None:
+                    self._written.pop(item, None)
+                else:
+                    self._written[item] = data
+        return
+
+    def _flush_worker(self) -> None:
+
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
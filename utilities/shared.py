@@ -1,28 +1,56 @@
-import logging
+from concurrent.futures import ThreadPoolExecutor
+import logging, time
 from functools import wraps
+from threading import Timer
 from telegram import Bot, ChatAction, ParseMode
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import ConversationHandler
-from utilities import calendar, database
+from telegram.utils.request import Request
+from utilities import calendar, database, metrics
+from utilities.cache import TTLCache
+from utilities.throttle import TokenBucket
 import config
 
 logger = logging.getLogger(__name__)
 
+# One long-lived bot client, so every module reuses the same keep-alive connection pool
+bot = Bot(config.BOT_TOKEN, request = Request(con_pool_size = config.BOT_CON_POOL_SIZE))
+
 '''
 DECORATORS
 '''
 # Decorate callback function to send typing action while processing
+# The action is sent in the background, and only if the callback is still running after TYPING_ACTION_DELAY
 def send_typing_action(func):
 
     @wraps(func)
     def wrapper(update, context, *args, **kwargs):
         kwargs['update'] = update
         kwargs['context'] = context
-        context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
-        return func(**kwargs)
+        typing = Timer(config.TYPING_ACTION_DELAY, send_chat_action, (context.bot, update.effective_message.chat_id))
+        typing.daemon = True
+        typing.start()
+        started = time.perf_counter()
+        try:
+            return func(**kwargs)
+        finally:
+            typing.cancel()
+            metrics.observe(f'handler.{func.__module__}.{func.__name__}', time.perf_counter() - started)
 
     return wrapper
 
 
+def send_chat_action(bot, chat_id: int) -> None:
+
+    try:
+        bot.send_chat_action(chat_id = chat_id, action = ChatAction.TYPING)
+        metrics.increment('typing_action.sent')
+    except Exception as error:
+        logger.warning('Chat Action Failure - %s - %s', chat_id, error)
+    return
+
+
 #Decorate callback function to load user profile before proceeding
 #Prompts user to create profile if it does not exist
 def load_user_profile(func):
@@ -40,7 +68,7 @@ def load_user_profile(func):
                 current_username = 'NULL'
             if context.user_data['username'] != current_username:
                 context.user_data['username'] = current_username
-                database.update_username(update.effective_user.id, current_username)
+                database.queue_username_update(update.effective_user.id, current_username)
         else:
             update.effective_chat.send_message("⚠ Sorry, I can't find your user profile. Send /start to create a new profile.")
             logger.debug('User Not Found - %s - %s', update.effective_user.id, update.effective_user.username)
@@ -66,7 +94,7 @@ def send_date_error(update, context, logger) -> None:
     logger.debug('Invalid Booking Date - %s - %s - "%s"', 
         update.effective_user.id,
         context.user_data['rank_and_name'],
-        update.message.text
+        update.effective_message.text
     )
     
     return
@@ -84,7 +112,7 @@ def send_time_range_error(update, context, logger) -> None:
     logger.debug('Invalid Booking Time Range - %s - %s - "%s"',
         update.effective_user.id,
         context.user_data['rank_and_name'],
-        update.message.text
+        update.effective_message.text
     )
     
     return
@@ -106,20 +134,76 @@ def construct_commands_list() -> str:
     return commands
 
 
+'''
+POC PRIVACY LOOKUPS
+Whether a user hides their account in forwarded messages decides if a POC
+link can point to their profile. Results are cached, and the lookups for a
+list of POCs run concurrently.
+'''
+private_forwards_cache = TTLCache('privacy_cache', maxsize = config.PRIVACY_CACHE_SIZE, ttl = config.PRIVACY_CACHE_TTL)
+privacy_lookup_pool = ThreadPoolExecutor(max_workers = config.PRIVACY_LOOKUP_WORKERS, thread_name_prefix = 'privacy-lookup')
+
+
+def has_private_forwards(user_id) -> bool:
+    
+    if (private_forwards := private_forwards_cache.get(int(user_id))) is not None:
+        return private_forwards
+    try:
+        private_forwards = bool(bot.get_chat(user_id).has_private_forwards)
+    except Exception as error:
+        logger.warning('Chat Privacy Lookup Failure - %s - %s', user_id, error)
+        return True # don't link to a profile we can't check, and don't cache the failure
+    private_forwards_cache.set(int(user_id), private_forwards)
+    return private_forwards
+
+
+def prefetch_private_forwards(user_ids) -> None:
+    
+    uncached = {int(user_id) for user_id in user_ids if int(user_id) not in private_forwards_cache}
+    list(privacy_lookup_pool.map(has_private_forwards, uncached))
+    return
+
+
 '''
 ADDITIONAL API REQUESTS
+Channel posts are outbox steps that follow a booking's calendar write (see
+utilities/calendar.py), sent within Telegram's per-channel rate limit and
+retried with the outbox's backoff. A backlog is sent as one digest.
 '''
-def update_facilities_channel(text: str) -> None:
+channel_bucket = TokenBucket(rate = config.CHANNEL_POSTS_PER_MINUTE / 60, capacity = 1) # evenly spaced posts
+
+
+# Join posts into as few messages as fit Telegram's length limit
+def build_digest(posts: list) -> list:
     
-    if config.CHANNEL_USERNAME:
-        try:
-            Bot(config.BOT_TOKEN).send_message(
-                chat_id = f'@{config.CHANNEL_USERNAME}',
-                text = text,
-                parse_mode = ParseMode.HTML,
-                disable_web_page_preview = True,
-                disable_notification = config.CHANNEL_MUTED
-            )
-        except Exception as error:
-            logger.exception('Channel Update Failure - %s', error)
-    return
\ No newline at end of file
+    messages = []
+    for post in posts:
+        if messages and len(messages[-1]) + len(post) + 2 <= MAX_MESSAGE_LENGTH:
+            messages[-1] += f'\n\n{post}'
+        else:
+            messages.append(post)
+    return messages
+
+
+# Raises on failure, for the outbox to retry
+def send_channel_post(text: str) -> None:
+    
+    channel_bucket.acquire()
+    try:
+        bot.send_message(
+            chat_id = f'@{config.CHANNEL_USERNAME}',
+            text = text,
+            parse_mode = ParseMode.HTML,
+            disable_web_page_preview = True,
+            disable_notification = config.CHANNEL_MUTED
+        )
+    except RetryAfter as error:
+        logger.warning('Channel Update Rate Limited - retrying in %ss', error.retry_after)
+        channel_bucket.drain()
+        raise
+    return
+
+
+# Timeouts, network errors and flood control pass; a rejected post won't succeed on retry
+def is_retryable_channel_error(error) -> bool:
+    return isinstance(error, (RetryAfter, NetworkError)) and not isinstance(error, BadRequest)
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib, logging
+import ujson
+from telegram import BotCommandScopeChat, ChatAdministratorRights
+from utilities import database
+import config
+
+logger = logging.getLogger(__name__)
+
+'''
+STARTUP PLANNER
+Bot commands and channel admin rights are only sent to Telegram when they
+differ from what was last applied, which is kept in the settings table as a
+hash. The calls that are needed run concurrently.
+'''
+def configuration_hash(value) -> str:
+    return hashlib.sha256(ujson.dumps(value, sort_keys = True).encode()).hexdigest()
+
+
+def apply_bot_configuration(bot) -> None:
+
+    default_commands = config.COMMANDS_BOOKING + config.COMMANDS_SETTING
+    admin_commands = config.COMMANDS_ADMIN + default_commands
+
+    # Default bot admin rights for facilities log channel
+    rights = ChatAdministratorRights(
+        is_anonymous = False,
+        can_manage_chat = False,
+        can_delete_messages = False,
+        can_manage_video_chats = False,
+        can_restrict_members = False,
+        can_promote_members = False,
+        can_change_info = False,
+        can_invite_users = False,
+        can_post_messages = True
+    )
+
+    desired = {
+        'bot_commands_hash': configuration_hash([default_commands, admin_commands, sorted(config.ADMIN_USERS)]),
+        'channel_rights_hash': configuration_hash(rights.to_dict())
+    }
+    applied = database.retrieve_settings()
+
+    # Admin users are always reconciled, since users who registered since the last boot may need the flag
+    steps = {'admin_users': [partial(reconcile_admins, bot)]}
+    if applied.get('bot_commands_hash') != desired['bot_commands_hash']:
+        steps['bot_commands_hash'] = [partial(bot.set_my_commands, default_commands)] + [
+            partial(bot.set_my_commands, admin_commands, scope = BotCommandScopeChat(admin_uid))
+            for admin_uid in config.ADMIN_USERS
+        ]
+    if applied.get('channel_rights_hash') != desired['channel_rights_hash']:
+        steps['channel_rights_hash'] = [partial(bot.set_my_default_administrator_rights, rights, for_channels = True)]
+
+    calls = sum(len(step) for step in steps.values())
+    with ThreadPoolExecutor(max_workers = min(calls, config.BOT_CON_POOL_SIZE), thread_name_prefix = 'startup') as pool:
+        futures = {name: [pool.submit(call) for call in step] for name, step in steps.items()}
+
+    for name, step_futures in futures.items():
+        if (errors := [future.exception() for future in step_futures if future.exception()]):
+            logger.error('Startup Step Failure - %s - %s', name, errors[0]) # retried on the next boot
+        elif name in desired:
+            database.save_setting(name, desired[name])
+    logger.info('Startup Steps Applied - %s', ', '.join(steps))
+    return
+
+
+# Update admin users
+def reconcile_admins(bot) -> None:
+
+    added, removed = database.sync_admins(config.ADMIN_USERS)
+    for user_id in removed:
+        bot.delete_my_commands(BotCommandScopeChat(user_id))
+    if added or removed:
+        logger.info('Admin Users Updated - added %s - removed %s', sorted(added), sorted(removed))
+    return
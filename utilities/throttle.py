@@ -0,0 +1,71 @@
+from threading import Condition
+import time
+
+class ThrottleTimeout(Exception):
+    pass
+
+
+'''
+TOKEN BUCKET
+Refills continuously at `rate` tokens per second, up to `capacity`.
+Callers acquiring with priority are served before the others waiting.
+'''
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._priority_waiting = 0
+        self._condition = Condition()
+
+    def _refill(self) -> None:
+
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return
+
+    # Block until a token is available; returns seconds waited, or None on timeout
+    def acquire(self, timeout: float = None, priority: bool = False):
+
+        started = time.monotonic()
+        with self._condition:
+            if priority:
+                self._priority_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._tokens >= 1 and (priority or not self._priority_waiting):
+                        self._tokens -= 1
+                        return time.monotonic() - started
+                    yielding = self._tokens >= 1 # a priority caller is about to take the token
+                    wait = (1 if yielding else 1 - self._tokens) / self.rate
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - started)
+                        if remaining <= 0 or (not yielding and remaining < wait):
+                            return None
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                if priority:
+                    self._priority_waiting -= 1
+                    self._condition.notify_all()
+
+    # Give back a token that went unused
+    def release(self) -> None:
+
+        with self._condition:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + 1)
+            self._condition.notify_all()
+        return
+
+    # Empty the bucket, e.g. after the server says to back off
+    def drain(self) -> None:
+
+        with self._condition:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+        return